@@ -18,6 +18,7 @@ class BotConfig(BaseModel):
 
 class DatabaseConfig(BaseModel):
     db_path: str = Field(default="vpn_bot.db", description="Path to SQLite database file")
+    pool_size: int = Field(default=4, description="Number of threads (and connections) for database queries")
 
 
 class PaymentConfig(BaseModel):
@@ -47,6 +48,7 @@ def load_config() -> AppConfig:
     )
     database = DatabaseConfig(
         db_path=os.getenv("DB_PATH", "vpn_bot.db"),
+        pool_size=int(os.getenv("DB_POOL_SIZE", "4")),
     )
     payment = PaymentConfig(
         referral_bonus=float(os.getenv("REFERRAL_BONUS", "50.0")),
@@ -1,5 +1,6 @@
 import sqlite3
 import secrets
+import threading
 import pytz
 import logging
 from datetime import datetime, timedelta
@@ -8,8 +9,21 @@ from contextlib import contextmanager
 DATABASE_FILE = "vpn_bot.db"
 REFERRAL_BONUS_DAYS = 5
 
+# Долгоживущие соединения: по одному на поток и файл БД
+_local = threading.local()
+
+def _configure_connection(conn: sqlite3.Connection):
+    """Включает WAL и настраивает кэш, чтобы запись не блокировала чтение"""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    # Чтение через отображение файла в память, без копирования страниц через read()
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+
 def init_db(db_path: str = DATABASE_FILE):
-    with sqlite3.connect(db_path) as conn:
+    with get_connection(db_path) as conn:
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -58,6 +72,15 @@ def init_db(db_path: str = DATABASE_FILE):
             except Exception as e:
                 logging.warning(f"Could not add server_id column: {e}")
 
+        # user_id - это rowid, а referral_code уже проиндексирован через UNIQUE,
+        # поэтому индексируем только выборки активных подписок
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_sub
+            ON users(pay_subscribed, subscription_end)
+        ''')
+        # Проверка перед удалением сервера: есть ли пользователи на нем
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_server ON users(server_id)')
+
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS subscriptions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -169,6 +192,14 @@ def init_db(db_path: str = DATABASE_FILE):
                     INSERT INTO announcements (text) VALUES (?)
                 ''', (default_text,))
 
+        # Объявление хранится в единственной строке с id = 1: переносим туда
+        # последнее объявление и удаляем остальные (старые версии бота добавляли новые строки)
+        cursor.execute('''
+            INSERT OR IGNORE INTO announcements (id, text)
+            SELECT 1, text FROM announcements ORDER BY id DESC LIMIT 1
+        ''')
+        cursor.execute('DELETE FROM announcements WHERE id != 1')
+
         # Таблица для VPN ключей
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS vpn_keys (
@@ -187,17 +218,41 @@ def init_db(db_path: str = DATABASE_FILE):
             )
         ''')
 
+        # Список ключей пользователя (с сортировкой по дате) и подсчет его активных ключей
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_created ON vpn_keys(user_id, created_at DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_active ON vpn_keys(user_id, is_active)')
+
         conn.commit()
 
-def get_connection(db_path: str = DATABASE_FILE):
-    return sqlite3.connect(db_path)
+        # Обновляем статистику планировщика, если она устарела или индексы новые
+        cursor.execute('PRAGMA optimize')
+
+def get_connection(db_path: str = DATABASE_FILE) -> sqlite3.Connection:
+    """Возвращает соединение текущего потока, открывая его при первом обращении.
+
+    Соединение не закрывается после использования: `with get_connection(...)`
+    лишь фиксирует или откатывает транзакцию.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        # Кэш подготовленных выражений: повторные запросы не компилируются заново
+        conn = sqlite3.connect(db_path, cached_statements=256)
+        _configure_connection(conn)
+        connections[db_path] = conn
+    return conn
 
-async def check_expired_subscriptions(db_path: str = DATABASE_FILE):
+def check_expired_subscriptions(db_path: str = DATABASE_FILE) -> list[int]:
+    """Отключает просроченные подписки одним UPDATE и возвращает ID затронутых пользователей"""
     current_time = datetime.now(pytz.timezone('Europe/Moscow')).strftime('%Y-%m-%d %H:%M:%S')
 
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         try:
+            # Даты хранятся как 'YYYY-MM-DD[ HH:MM:SS]', поэтому строковое сравнение
+            # совпадает с datetime() и позволяет использовать idx_users_sub
             cursor.execute('''
                 UPDATE users 
                 SET 
@@ -206,14 +261,18 @@ async def check_expired_subscriptions(db_path: str = DATABASE_FILE):
                     renewal_used = 0 
                 WHERE 
                     pay_subscribed = 1 
-                    AND datetime(subscription_end) < datetime(?)
+                    AND subscription_end < ?
+                RETURNING user_id
             ''', (current_time,))
+            expired_ids = [row[0] for row in cursor.fetchall()]
 
             conn.commit()
 
-            if cursor.rowcount > 0:
-                logging.info(f"Отключено {cursor.rowcount} просроченных подписок")
+            if expired_ids:
+                logging.info(f"Отключено {len(expired_ids)} просроченных подписок")
+            return expired_ids
 
         except Exception as e:
             logging.error(f"Ошибка при проверке подписок: {str(e)}")
             conn.rollback()
+            return []
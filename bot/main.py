@@ -1,12 +1,17 @@
 import os
+import re
 import asyncio
 import secrets
 import logging
 import time
-from datetime import datetime, timedelta
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
 from urllib.parse import quote
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, PreCheckoutQuery, LabeledPrice
 from aiogram.fsm.context import FSMContext
@@ -15,6 +20,12 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import pytz
 
+try:
+    # uvloop ставится только на Linux (см. requirements.txt), иначе работаем на стандартном цикле
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from .config import load_config
 from .xui_client import XUIClient
 from .database import init_db, get_connection, check_expired_subscriptions
@@ -22,77 +33,96 @@ from .database import init_db, get_connection, check_expired_subscriptions
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
+@dataclass(frozen=True, slots=True)
+class Plan:
+    """План подписки; цены в копейках (RUB) и в звездах (XTR)"""
+    title: str
+    duration: int
+    traffic_gb: int
+    price_rub: int
+    price_stars: int
+    new_user: bool
+    # Цена по валюте платежа, чтобы не ветвиться по методу оплаты при каждом счете
+    price_by_currency: dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "price_by_currency", {"XTR": self.price_stars, "RUB": self.price_rub})
+
 # Планы подписки
 SUBSCRIPTION_PLANS = {
-    "1_month": {
-        "title": "1 месяц",
-        "duration": 1,
-        "traffic_gb": 100,
-        "price_rub": 19900,  # 199₽
-        "price_stars": 199,
-        "new_user": True
-    },
-    "3_months": {
-        "title": "3 месяца",
-        "duration": 3,
-        "traffic_gb": 300,
-        "price_rub": 49900,  # 499₽
-        "price_stars": 499,
-        "new_user": True
-    },
-    "6_months": {
-        "title": "6 месяцев",
-        "duration": 6,
-        "traffic_gb": 600,
-        "price_rub": 89900,  # 899₽
-        "price_stars": 899,
-        "new_user": True
-    },
-    "12_months": {
-        "title": "12 месяцев",
-        "duration": 12,
-        "traffic_gb": 1200,
-        "price_rub": 149900,  # 1499₽
-        "price_stars": 1499,
-        "new_user": True
-    }
+    "1_month": Plan(
+        title="1 месяц",
+        duration=1,
+        traffic_gb=100,
+        price_rub=19900,  # 199₽
+        price_stars=199,
+        new_user=True
+    ),
+    "3_months": Plan(
+        title="3 месяца",
+        duration=3,
+        traffic_gb=300,
+        price_rub=49900,  # 499₽
+        price_stars=499,
+        new_user=True
+    ),
+    "6_months": Plan(
+        title="6 месяцев",
+        duration=6,
+        traffic_gb=600,
+        price_rub=89900,  # 899₽
+        price_stars=899,
+        new_user=True
+    ),
+    "12_months": Plan(
+        title="12 месяцев",
+        duration=12,
+        traffic_gb=1200,
+        price_rub=149900,  # 1499₽
+        price_stars=1499,
+        new_user=True
+    )
 }
 
 RENEWAL_PLANS = {
-    "1_month_renew": {
-        "title": "1 месяц 🔥",
-        "duration": 1,
-        "traffic_gb": 100,
-        "price_rub": 14900,  # 149₽
-        "price_stars": 149,
-        "new_user": False
-    },
-    "3_months_renew": {
-        "title": "3 месяца 🔥",
-        "duration": 3,
-        "traffic_gb": 300,
-        "price_rub": 39900,  # 399₽
-        "price_stars": 399,
-        "new_user": False
-    },
-    "6_months_renew": {
-        "title": "6 месяцев 🔥",
-        "duration": 6,
-        "traffic_gb": 600,
-        "price_rub": 74900,  # 749₽
-        "price_stars": 749,
-        "new_user": False
-    },
-    "12_months_renew": {
-        "title": "12 месяцев 🔥",
-        "duration": 12,
-        "traffic_gb": 1200,
-        "price_rub": 119900,  # 1199₽
-        "price_stars": 1199,
-        "new_user": False
-    }
+    "1_month_renew": Plan(
+        title="1 месяц 🔥",
+        duration=1,
+        traffic_gb=100,
+        price_rub=14900,  # 149₽
+        price_stars=149,
+        new_user=False
+    ),
+    "3_months_renew": Plan(
+        title="3 месяца 🔥",
+        duration=3,
+        traffic_gb=300,
+        price_rub=39900,  # 399₽
+        price_stars=399,
+        new_user=False
+    ),
+    "6_months_renew": Plan(
+        title="6 месяцев 🔥",
+        duration=6,
+        traffic_gb=600,
+        price_rub=74900,  # 749₽
+        price_stars=749,
+        new_user=False
+    ),
+    "12_months_renew": Plan(
+        title="12 месяцев 🔥",
+        duration=12,
+        traffic_gb=1200,
+        price_rub=119900,  # 1199₽
+        price_stars=1199,
+        new_user=False
+    )
 }
 
+# Планы неизменны после загрузки, поэтому объединяем их один раз
+_ALL_PLANS = {**SUBSCRIPTION_PLANS, **RENEWAL_PLANS}
+_RENEWAL_IDS = frozenset(RENEWAL_PLANS)
+
 # Методы оплаты
 PAYMENT_METHODS = {
     "stars": {
@@ -107,8 +137,142 @@ PAYMENT_METHODS = {
     }
 }
 
+# Компактный payload счета: индексы плана и метода оплаты вместо их имен.
+# Новые планы и методы добавляются только в конец, чтобы индексы не сдвигались
+_PLAN_IDS = tuple(_ALL_PLANS)
+_PLAN_IDX = {plan_id: i for i, plan_id in enumerate(_PLAN_IDS)}
+_METHOD_IDS = tuple(PAYMENT_METHODS)
+_METHOD_IDX = {method_id: i for i, method_id in enumerate(_METHOD_IDS)}
+
+# Параметры счета зависят только от плана и метода оплаты, собираем их заранее.
+# Не сохраняем server_id в payload - пользователь создаст ключ позже в разделе "Мои ключи"
+_INVOICES = {
+    (plan_id, method_id): dict(
+        title=f"VPN подписка - {plan_data.title}",
+        description="Нажимая кнопку «Заплатить» Вы соглашаетесь с правилами VPN бота (/help)",
+        provider_token=method_data['provider_token'],
+        currency=method_data['currency'],
+        prices=[LabeledPrice(label="VPN подписка", amount=plan_data.price_by_currency[method_data["currency"]])],
+        payload=f"{_PLAN_IDX[plan_id]}:{_METHOD_IDX[method_id]}",
+        start_parameter='subscription'
+    )
+    for plan_id, plan_data in _ALL_PLANS.items()
+    for method_id, method_data in PAYMENT_METHODS.items()
+}
+
 POLICY_LINK = "https://telegra.ph/Konfidencialnost-i-usloviya-02-01"
 
+# Приветствие нового пользователя (между частями вставляется блок о реферальном бонусе)
+WELCOME_HEAD = "<b>VPN бот</b> — быстрый и надежный VPN сервис\n\n"
+WELCOME_TAIL = (
+    "<b>Бот предоставляет</b>:\n"
+    "• Безопасный и быстрый VPN\n"
+    "• Обход блокировок\n"
+    "• Высокая скорость\n\n"
+    "👉 Больше информации в разделе <b>помощь</b> - /help\n\n"
+    f"‼️ Продолжая использовать бота, вы принимаете <a href='{POLICY_LINK}'>нашу политику и конфиденциальность</a>!\n\n"
+)
+
+def _build_plans_markup(plans: dict) -> InlineKeyboardMarkup:
+    """Клавиатура выбора плана с кнопкой "Назад" """
+    builder = InlineKeyboardBuilder()
+    for plan_id, plan_data in plans.items():
+        builder.button(
+            text=f"{plan_data.title} - {plan_data.price_rub // 100}₽ | {plan_data.price_stars}⭐",
+            callback_data=f"plan:{plan_id}"
+        )
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="go_back"))
+    return builder.as_markup()
+
+# Планы не меняются во время работы, поэтому клавиатуры строим один раз
+PLANS_MARKUP = _build_plans_markup(SUBSCRIPTION_PLANS)
+RENEWAL_MARKUP = _build_plans_markup(RENEWAL_PLANS)
+BACK_MARKUP = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад", callback_data="go_back")]
+])
+
+KEYS_BACK_MARKUP = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="◀️ Назад к ключам", callback_data="manage_keys")]
+])
+
+def _build_payment_methods_markup() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for method_id, method_data in PAYMENT_METHODS.items():
+        builder.button(
+            text=method_data['title'],
+            callback_data=f"method:{method_id}"
+        )
+    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="sub_back_to_plan"))
+    builder.adjust(1)
+    return builder.as_markup()
+
+PAYMENT_METHODS_MARKUP = _build_payment_methods_markup()
+
+ADMIN_SERVERS_MARKUP = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Добавить сервер", callback_data="admin_add_server")],
+    [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_refresh_servers")]
+])
+
+def _key_actions_markup(key_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🗑️ Удалить", callback_data=f"delete_key:{key_id}")],
+        [InlineKeyboardButton(text="🔄 Заменить", callback_data=f"replace_key:{key_id}")],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="manage_keys")]
+    ])
+
+def _delete_confirm_markup(key_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"confirm_delete:{key_id}")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data=f"view_key:{key_id}")]
+    ])
+
+HELP_TEXT = (
+    "🤖<b>VPN бот</b> — быстрый и надежный VPN сервис\n\n"
+    "<b>Бот предоставляет</b>:\n"
+    "• Быстрый и безопасный VPN\n"
+    "• Обход всех блокировок\n"
+    "• Высокая скорость подключения\n\n"
+    "<b>Как пользоваться</b>?\n"
+    "• Купите подписку через /prem\n"
+    "• Получите VPN ссылку\n"
+    "• Импортируйте ссылку в приложение (v2rayNG, sing-box и т.п.)\n"
+    "• Подключитесь!\n\n"
+    "<b>Реферальная программа</b>:\n"
+    "• Пригласите друга через /invite\n"
+    "• Вы получите +5 дней VPN\n"
+    "• Друг получит +3 дня VPN\n\n"
+    "📌 <b>Команды</b>:\n"
+    "/start - Перезагрузить бота\n"
+    "/prem - Покупка VPN\n"
+    "/invite - Пригласи друга\n"
+)
+
+# Напоминание об окончании подписки: шаблон заполняется через format_map
+REMINDER_TEMPLATE = (
+    "⏰ <b>Напоминание о подписке</b>\n\n"
+    "Ваша VPN подписка истекает <b>через {days} дней</b> ({end_date})\n\n"
+    "🔥 <b>Сейчас действует скидка!</b>\n"
+    "Успей продлить подписку сейчас и получи выгодную цену.\n\n"
+    "Не упусти возможность продолжить пользоваться VPN по специальной цене! 🎁"
+)
+
+# Текст для кнопки "Поделиться" уже закодирован для URL
+SHARE_TEXT = quote('Присоединяйся к VPN боту с моей подпиской!')
+
+# Префиксы callback_data: по ним и фильтруем обработчики, и отрезаем аргумент без split
+_PFX_PLAN = "plan:"
+_PFX_METHOD = "method:"
+_PFX_KEY_SERVER = "key_server:"
+_PFX_VIEW_KEY = "view_key:"
+_PFX_DELETE_KEY = "delete_key:"
+_PFX_CONFIRM_DELETE = "confirm_delete:"
+_PFX_REPLACE_KEY = "replace_key:"
+# Callback с двумя аргументами разбираются регулярным выражением прямо в фильтре:
+# совпадение передается в обработчик как match, без split и промежуточного списка
+_REPLACE_KEY_SERVER_RE = re.compile(r"replace_key_server:(\d+):(\d+)")
+_FEEDBACK_RATING_RE = re.compile(r"feedback_rating:(\d+)(?::(\d+))?")
+
 class SubscriptionSteps(StatesGroup):
     CHOOSING_PLAN = State()
     CHOOSING_PAYMENT_METHOD = State()
@@ -128,53 +292,100 @@ class AdminEditStates(StatesGroup):
 
 class KeyManagementStates(StatesGroup):
     CHOOSING_SERVER_FOR_KEY = State()
-    ENTERING_KEY_NAME = State()
     VIEWING_KEY = State()
     CONFIRMING_DELETE = State()
     CONFIRMING_REPLACE = State()
 
+# Текст объявления меняется только через set_announcement_text, поэтому держим его в памяти
+@lru_cache(maxsize=1)
 def get_announcement_text() -> str:
-    """Получает текст объявления из БД"""
-    with get_connection(cfg.database.db_path) as conn:
+    """Получает текст объявления (из кэша или БД)"""
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT text FROM announcements ORDER BY id DESC LIMIT 1')
+        cursor.execute('SELECT text FROM announcements WHERE id = 1')
         result = cursor.fetchone()
-        if result:
-            return result[0]
     # Дефолтный текст, если в БД ничего нет
-    return "!!!ВНИМАНИЕ!!! Это бета-тест, VPN работает нестабильно, платежи также находятся в тестировании - они не реальны!!!\n"
+    return result[0] if result else "!!!ВНИМАНИЕ!!! Это бета-тест, VPN работает нестабильно, платежи также находятся в тестировании - они не реальны!!!\n"
 
 def set_announcement_text(new_text: str):
     """Сохраняет текст объявления в БД"""
-    with get_connection(cfg.database.db_path) as conn:
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        # Проверяем наличие колонки updated_at
-        cursor.execute("PRAGMA table_info(announcements)")
-        columns = [column[1] for column in cursor.fetchall()]
-        has_updated_at = 'updated_at' in columns
-        
-        # Удаляем старые объявления и добавляем новое
-        cursor.execute('DELETE FROM announcements')
-        if has_updated_at:
+        # Объявление хранится в одной строке с id = 1, обновляем ее на месте
+        if HAS_UPDATED_AT:
             cursor.execute('''
-                INSERT INTO announcements (text, updated_at) VALUES (?, CURRENT_TIMESTAMP)
+                UPDATE announcements SET text = ?, updated_at = CURRENT_TIMESTAMP WHERE id = 1
             ''', (new_text.strip(),))
         else:
             cursor.execute('''
-                INSERT INTO announcements (text) VALUES (?)
+                UPDATE announcements SET text = ? WHERE id = 1
             ''', (new_text.strip(),))
         conn.commit()
+    get_announcement_text.cache_clear()
+    # Прогреваем кэш здесь же, в пуле БД, чтобы обработчики не читали БД в цикле событий
+    get_announcement_text()
 
 cfg = load_config()
+# Путь к БД нужен почти каждому обработчику, читаем его из конфига один раз
+_DB_PATH = cfg.database.db_path
 bot = Bot(token=cfg.bot.bot_token)
 dp = Dispatcher()
 xui_client = XUIClient(cfg.xui)
 
-init_db(cfg.database.db_path)
-
-def get_main_keyboard(user_id: int):
+init_db(_DB_PATH)
+
+def _table_columns(table: str) -> set[str]:
+    with get_connection(_DB_PATH) as conn:
+        return {column[1] for column in conn.execute(f"PRAGMA table_info({table})")}
+
+# Схема не меняется после init_db, поэтому наличие колонок проверяем один раз при старте
+HAS_UPDATED_AT = 'updated_at' in _table_columns('announcements')
+HAS_VLESS_LINK = 'vless_link' in _table_columns('users')
+# Объявление читаем при старте, чтобы первый /start не ходил за ним в БД из цикла событий
+get_announcement_text()
+
+SQL_SUBSCRIPTION_INFO = 'SELECT subscription_end, vless_link, pay_subscribed FROM users WHERE user_id = ?'
+SQL_SUBSCRIPTION_INFO_NO_LINK = 'SELECT subscription_end, NULL AS vless_link, pay_subscribed FROM users WHERE user_id = ?'
+
+# Запросы горячих обработчиков: один и тот же текст SQL попадает в кэш
+# подготовленных выражений соединения и не компилируется повторно
+SQL_GET_USER_REF = 'SELECT referral_code, referral_count FROM users WHERE user_id = ?'
+SQL_SET_USER_REF = 'UPDATE users SET referral_code = ? WHERE user_id = ?'
+SQL_ACTIVE_SERVERS = 'SELECT id, name, ip, username, password, inbound_id, base_url FROM servers WHERE is_active = TRUE ORDER BY name'
+SQL_SERVER_BY_ID = 'SELECT id, name, ip, username, password, inbound_id, base_url FROM servers WHERE id = ?'
+# Даты подписки сравниваются в SQL; 'localtime' - как и _TODAY, по времени сервера
+SQL_SUB_AND_KEYS_COUNT = '''
+    SELECT u.pay_subscribed = 1 AND u.subscription_end >= date('now', 'localtime'),
+           (SELECT COUNT(*) FROM vpn_keys k WHERE k.user_id = u.user_id AND k.is_active = TRUE)
+    FROM users u
+    WHERE u.user_id = ?
+'''
+# EXISTS останавливается на первой записи индекса по user_id
+SQL_SUB_AND_HAS_KEYS = '''
+    SELECT u.pay_subscribed = 1 AND u.subscription_end >= date('now', 'localtime'),
+           EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.user_id)
+    FROM users u
+    WHERE u.user_id = ?
+'''
+SQL_USER_KEYS = '''
+    SELECT k.id, k.key_name, k.vless_link, k.created_at, k.expires_at, 
+           k.traffic_gb, k.is_active, s.name as server_name
+    FROM vpn_keys k
+    LEFT JOIN servers s ON k.server_id = s.id
+    WHERE k.user_id = ?
+    ORDER BY k.created_at DESC
+'''
+SQL_KEY_BY_ID = '''
+    SELECT k.id, k.key_name, k.vless_link, k.vless_client_id, k.created_at, 
+           k.expires_at, k.traffic_gb, k.is_active, k.server_id, s.name as server_name
+    FROM vpn_keys k
+    LEFT JOIN servers s ON k.server_id = s.id
+    WHERE k.id = ? AND k.user_id = ?
+'''
+
+def _build_main_keyboard(admin: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    if is_admin(user_id):
+    if admin:
         builder.row(InlineKeyboardButton(text="✏️ Редактировать объявление", callback_data="edit_announcement"))
         builder.row(
             InlineKeyboardButton(text="🧪 Тест напоминания", callback_data="admin_test_reminder"),
@@ -192,10 +403,75 @@ def get_main_keyboard(user_id: int):
     )
     return builder.as_markup()
 
+# Главное меню отличается только админской строкой, поэтому строим оба варианта один раз
+_MAIN_KB_USER = _build_main_keyboard(admin=False)
+_MAIN_KB_ADMIN = _build_main_keyboard(admin=True)
+
+def get_main_keyboard(is_admin_flag: bool) -> InlineKeyboardMarkup:
+    return _MAIN_KB_ADMIN if is_admin_flag else _MAIN_KB_USER
+
+class AdminFlagMiddleware(BaseMiddleware):
+    """Один раз на апдейт определяет, является ли отправитель админом"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        data["is_admin"] = is_admin(user.id) if user else False
+        return await handler(event, data)
+
+dp.message.outer_middleware(AdminFlagMiddleware())
+dp.callback_query.outer_middleware(AdminFlagMiddleware())
+
+# Текущая дата, обновляется планировщиком раз в час
+_TODAY = date.today()
+
+def _refresh_today():
+    global _TODAY
+    _TODAY = date.today()
+
+def _parse_date(value: str) -> date:
+    """Разбирает 'YYYY-MM-DD' (или 'YYYY-MM-DD HH:MM:SS') без strptime"""
+    return date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+def _format_date(d: date) -> str:
+    return f"{d.day:02d}.{d.month:02d}.{d.year}"
+
+def _iso_to_ddmmyyyy(value: str) -> str:
+    """'YYYY-MM-DD[ HH:MM:SS]' -> 'DD.MM.YYYY' срезами строки"""
+    return f"{value[8:10]}.{value[5:7]}.{value[0:4]}"
+
+def _parse_sub(end_raw: str | None) -> tuple[bool, int, str | None]:
+    """Возвращает (активна ли подписка, осталось дней, дата окончания для вывода)"""
+    if not end_raw:
+        return (False, 0, None)
+    try:
+        # end_raw[:10] отбрасывает время, если оно есть
+        end_date = _parse_date(end_raw[:10])
+    except ValueError:
+        logger.error("Error parsing subscription date: %s", end_raw)
+        return (False, 0, None)
+    if end_date < _TODAY:
+        return (False, 0, None)
+    return (True, (end_date - _TODAY).days, _format_date(end_date))
+
+def _format_subscription_status(subscription_end, pay_subscribed) -> str:
+    """Форматирует статус подписки по уже полученным полям пользователя"""
+    if pay_subscribed != 1:
+        return "неактивен"
+    is_active, _, end_date_str = _parse_sub(subscription_end)
+    return f"активен до {end_date_str}" if is_active else "неактивен"
+
+def _reminder_text(end_date: date) -> tuple[int, str]:
+    """Остаток дней и текст напоминания; дни считаются от _TODAY, как в разделе подписки"""
+    days_remaining = (end_date - _TODAY).days
+    return days_remaining, REMINDER_TEMPLATE.format_map({
+        'days': "&lt;1" if days_remaining < 1 else days_remaining,
+        'end_date': _format_date(end_date),
+    })
+
 def get_subscription_status(user_id: int) -> str:
     """Получает статус подписки пользователя"""
     try:
-        with get_connection(cfg.database.db_path) as conn:
+        with get_connection(_DB_PATH) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT subscription_end, pay_subscribed 
@@ -203,69 +479,119 @@ def get_subscription_status(user_id: int) -> str:
                 WHERE user_id = ?
             ''', (user_id,))
             user_data = cursor.fetchone()
-
-            if user_data and user_data[1] == 1 and user_data[0]:
-                try:
-                    subscription_end = user_data[0]
-                    # Парсим дату с учетом возможного формата с временем
-                    if isinstance(subscription_end, str):
-                        if ' ' in subscription_end:
-                            end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
-                        else:
-                            end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
-                    else:
-                        end_date = subscription_end
-                    
-                    # Сравниваем только даты
-                    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                    end_date_only = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                    
-                    if end_date_only >= today:
-                        return f"активен до {end_date.strftime('%d.%m.%Y')}"
-                except Exception as e:
-                    logger.error(f"Error parsing subscription date in get_subscription_status: {e}, date: {user_data[0]}")
-                    return "неактивен"
+        if user_data:
+            return _format_subscription_status(*user_data)
     except Exception as e:
-        logger.error(f"Error in get_subscription_status: {e}")
+        logger.error("Error in get_subscription_status: %s", e)
     return "неактивен"
 
+_MAIN_TEMPLATE = (
+    "👋 Рады видеть тебя снова, <b>{first_name}</b>!\n\n"
+    "<b>VPN</b>: <i>{status}</i>\n\n"
+    "📌 <b>Команды:</b>\n"
+    "<i>/start</i> - Перезагрузить бота\n"
+    "<i>/prem</i> - Покупка VPN\n"
+    "<i>/invite</i> - Пригласи друга\n\n"
+    "<code>{ann}\nb1.1.19</code>"
+)
+
 def get_main_text(first_name: str, subscription_status: str, user_id: int = None) -> str:
     """Возвращает основной текст с объявлением"""
-    ann = get_announcement_text()
-    msg = (
-        f"👋 Рады видеть тебя снова, <b>{first_name}</b>!\n\n"
-        f"<b>VPN</b>: <i>{subscription_status}</i>\n\n"
-        f"📌 <b>Команды:</b>\n"
-        "<i>/start</i> - Перезагрузить бота\n"
-        "<i>/prem</i> - Покупка VPN\n"
-        "<i>/invite</i> - Пригласи друга\n\n"
-        f"<code>{ann}\nb1.1.19</code>"
+    return _MAIN_TEMPLATE.format(
+        first_name=first_name,
+        status=subscription_status,
+        ann=get_announcement_text()
     )
-    return msg
 
-@dp.message(CommandStart())
-async def handle_start(message: Message):
-    user_id = message.from_user.id
-    username = message.from_user.username
-    first_name = message.from_user.first_name
-    args = message.text.split()
+def _origin(message_or_callback: Message | CallbackQuery):
+    """Возвращает (пользователь, сообщение для ответа) для Message и CallbackQuery"""
+    if isinstance(message_or_callback, CallbackQuery):
+        return message_or_callback.from_user, message_or_callback.message
+    return message_or_callback.from_user, message_or_callback
 
-    # Парсим реферальный код
-    referral_code = args[1][4:] if len(args) > 1 and args[1].startswith('ref_') else None
+# Запас реферальных кодов: одно чтение случайных байт на 256 кодов
+_REF_CODES: deque[str] = deque()
 
-    with get_connection(cfg.database.db_path) as conn:
+def next_ref_code() -> str:
+    """Возвращает новый реферальный код (8 hex-символов, как secrets.token_hex(4))"""
+    try:
+        return _REF_CODES.popleft()
+    except IndexError:
+        raw = secrets.token_bytes(4 * 256).hex()
+        _REF_CODES.extend(raw[i:i + 8] for i in range(8, len(raw), 8))
+        return raw[:8]
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+_background_tasks: set[asyncio.Task] = set()
+
+def _log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка фоновой задачи: %s", task.exception())
+
+# Пул для синхронных запросов к SQLite, чтобы они не блокировали event loop.
+# Каждый поток пула держит свое соединение (см. get_connection), в WAL читатели не мешают друг другу
+_DB_POOL = ThreadPoolExecutor(max_workers=cfg.database.pool_size, thread_name_prefix="db")
+
+async def _run_db(func, *args):
+    """Выполняет синхронную функцию работы с БД в пуле потоков"""
+    return await asyncio.get_running_loop().run_in_executor(_DB_POOL, func, *args)
+
+def _spawn(coro) -> asyncio.Task:
+    """Запускает корутину в фоне, не дожидаясь результата"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_task_error)
+    return task
+
+def _notify_inviter(inviter_id: int):
+    """Уведомляет пригласившего о начисленном бонусе"""
+    return bot.send_message(
+        inviter_id,
+        f"🎉 Вы получили +5 дней VPN за приглашение друга!\n"
+        f"Теперь ваш VPN активен до: {_format_date(_TODAY + timedelta(days=5))}"
+    )
+
+def _register_user(user_id: int, username: str, first_name: str, referral_code: str | None):
+    """Регистрирует нового пользователя (с реферальным бонусом) или обновляет активность.
+
+    Возвращает (subscription_end, pay_subscribed) существующего пользователя или None
+    для нового, и ID пригласившего, если бонус начислен.
+    """
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        cursor.execute("SELECT subscription_end, pay_subscribed FROM users WHERE user_id = ?", (user_id,))
         user = cursor.fetchone()
 
+        inviter_id = None
         if not user:
-            # Создаем нового пользователя
-            new_referral_code = secrets.token_hex(4)
+            # Начисляем бонус пригласившему и сразу получаем его ID (до вставки нового
+            # пользователя, чтобы он не мог совпасть сам с собой)
+            if referral_code:
+                cursor.execute('''
+                    UPDATE users SET
+                        referral_count = referral_count + 1,
+                        subscription_end = CASE
+                            WHEN subscription_end IS NULL OR subscription_end < DATE('now', 'localtime')
+                            THEN DATE('now', 'localtime', '+5 days')
+                            ELSE DATE(subscription_end, '+5 days')
+                        END,
+                        pay_subscribed = 1
+                    WHERE referral_code = ?
+                    RETURNING user_id
+                ''', (referral_code,))
+                inviter = cursor.fetchone()
+                if inviter:
+                    inviter_id = inviter[0]
+            has_referral = inviter_id is not None
+
+            # Создаем нового пользователя сразу с реферальными данными
+            new_referral_code = next_ref_code()
             cursor.execute('''
                 INSERT INTO users (
-                    user_id, 
-                    username, 
-                    first_name, 
+                    user_id,
+                    username,
+                    first_name,
                     registration_date,
                     last_activity,
                     subscribed,
@@ -273,176 +599,84 @@ async def handle_start(message: Message):
                     invited_by,
                     pay_subscribed,
                     subscription_end
-                ) VALUES (?, ?, ?, datetime('now'), datetime('now'), FALSE, ?, NULL, FALSE, NULL)
-            ''', (user_id, username, first_name, new_referral_code))
-            conn.commit()
+                ) VALUES (?, ?, ?, datetime('now'), datetime('now'), FALSE, ?, ?, ?,
+                          CASE WHEN ? THEN DATE('now', 'localtime', '+3 days') END)
+            ''', (user_id, username, first_name, new_referral_code, inviter_id, has_referral, has_referral))
+        else:
+            # Обновляем активность
+            cursor.execute("UPDATE users SET last_activity = datetime('now') WHERE user_id = ?", (user_id,))
+        conn.commit()
 
-            # Обработка реферального кода
-            has_referral = False
-            if referral_code:
-                cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
-                inviter = cursor.fetchone()
+    return user, inviter_id
 
-                if inviter:
-                    inviter_id = inviter[0]
-                    # Обновляем данные пригласившего
-                    cursor.execute('''
-                        UPDATE users SET
-                            referral_count = referral_count + 1,
-                            subscription_end = CASE 
-                                WHEN subscription_end IS NULL OR subscription_end < DATE('now') 
-                                THEN DATE('now', '+5 days')
-                                ELSE DATE(subscription_end, '+5 days')
-                            END,
-                            pay_subscribed = 1
-                        WHERE user_id = ?
-                    ''', (inviter_id,))
-
-                    # Обновляем данные нового пользователя
-                    cursor.execute('''
-                        UPDATE users SET
-                            invited_by = ?,
-                            subscription_end = DATE('now', '+3 days'),
-                            pay_subscribed = 1
-                        WHERE user_id = ?
-                    ''', (inviter_id, user_id))
-                    conn.commit()
-
-                    # Уведомления
-                    try:
-                        await bot.send_message(
-                            inviter_id,
-                            f"🎉 Вы получили +5 дней VPN за приглашение друга!\n"
-                            f"Теперь ваш VPN активен до: {(datetime.now() + timedelta(days=5)).strftime('%d.%m.%Y')}"
-                        )
-                    except Exception as e:
-                        logging.error(f"Ошибка отправки уведомления: {e}")
-
-                    has_referral = True
+@dp.message(CommandStart())
+async def handle_start(message: Message, is_admin: bool):
+    user_id = message.from_user.id
+    username = message.from_user.username
+    first_name = message.from_user.first_name
+    args = message.text.split()
 
-            # Формируем приветственное сообщение
-            welcome_msg_parts = [
-                "<b>VPN бот</b> — быстрый и надежный VPN сервис\n\n"
-            ]
+    # Парсим реферальный код
+    referral_code = args[1][4:] if len(args) > 1 and args[1].startswith('ref_') else None
 
-            if has_referral:
-                expiration_date = (datetime.now() + timedelta(days=3)).strftime("%d.%m.%Y")
-                welcome_msg_parts.append(
-                    f"🎁 Вы получили +3 дня <b>VPN</b> за регистрацию по реферальной ссылке!\n"
-                    f"Ваш <b>VPN</b> активен до: {expiration_date}\n\n"
-                )
+    # Вся работа с БД (включая фиксацию транзакции) выполняется в пуле потоков
+    # и завершается до обращений к Telegram API
+    user, inviter_id = await _run_db(_register_user, user_id, username, first_name, referral_code)
+    has_referral = inviter_id is not None
 
-            welcome_msg_parts.extend([
-                "<b>Бот предоставляет</b>:\n"
-                "• Безопасный и быстрый VPN\n"
-                "• Обход блокировок\n"
-                "• Высокая скорость\n\n"
-                "👉 Больше информации в разделе <b>помощь</b> - /help\n\n"
-                "‼️ Продолжая использовать бота, вы принимаете <a href='https://telegra.ph/Konfidencialnost-i-usloviya-02-01'>нашу политику и конфиденциальность</a>!\n\n"
-            ])
+    if user:
+        # Статус считаем по строке, уже прочитанной выше
+        subscription_status = _format_subscription_status(*user)
+        await message.answer(
+            get_main_text(first_name, subscription_status, user_id),
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(is_admin)
+        )
+        return
 
-            welcome_msg = "".join(welcome_msg_parts)
+    if has_referral:
+        # Уведомление пригласившему не должно задерживать приветствие нового пользователя
+        _spawn(_notify_inviter(inviter_id))
 
-            await message.answer(
-                welcome_msg,
-                reply_markup=get_main_keyboard(user_id),
-                disable_web_page_preview=True,
-                parse_mode='HTML'
-            )
-        else:
-            # Обновляем активность
-            cursor.execute("UPDATE users SET last_activity = datetime('now') WHERE user_id = ?", (user_id,))
-            conn.commit()
+    # Формируем приветственное сообщение
+    referral_block = (
+        f"🎁 Вы получили +3 дня <b>VPN</b> за регистрацию по реферальной ссылке!\n"
+        f"Ваш <b>VPN</b> активен до: {_format_date(_TODAY + timedelta(days=3))}\n\n"
+    ) if has_referral else ""
+    welcome_msg = WELCOME_HEAD + referral_block + WELCOME_TAIL
 
-            subscription_status = get_subscription_status(user_id)
-            await message.answer(
-                get_main_text(first_name, subscription_status, user_id),
-                parse_mode="HTML",
-                reply_markup=get_main_keyboard(user_id)
-            )
+    await message.answer(
+        welcome_msg,
+        reply_markup=get_main_keyboard(is_admin),
+        disable_web_page_preview=True,
+        parse_mode='HTML'
+    )
 
-async def _get_subscription_info(user_id: int):
-    """Вспомогательная функция для получения информации о подписке"""
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        # Получаем данные пользователя - работаем с тем что есть
-        # Сначала проверяем, какие колонки есть в таблице
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        # Формируем запрос только с существующими колонками
-        select_fields = ['subscription_end', 'pay_subscribed']
-        if 'vless_link' in columns:
-            select_fields.insert(1, 'vless_link')
-        else:
-            select_fields.insert(1, 'NULL as vless_link')
-        
+def _select_subscription_info(user_id: int):
+    """Строка подписки пользователя (subscription_end, vless_link, pay_subscribed) или None"""
+    with get_connection(_DB_PATH) as conn:
         try:
-            query = f'SELECT {", ".join(select_fields)} FROM users WHERE user_id = ?'
-            cursor.execute(query, (user_id,))
-            result = cursor.fetchone()
+            query = SQL_SUBSCRIPTION_INFO if HAS_VLESS_LINK else SQL_SUBSCRIPTION_INFO_NO_LINK
+            return conn.execute(query, (user_id,)).fetchone()
         except Exception as e:
             # Если ошибка - используем дефолтные значения
-            logger.error(f"Database error in subscription info: {e}")
-            result = None
+            logger.error("Database error in subscription info: %s", e)
+            return None
+
+async def _get_subscription_info(user_id: int):
+    """Вспомогательная функция для получения информации о подписке"""
+    result = await _run_db(_select_subscription_info, user_id)
     
     # Обрабатываем данные пользователя
     if result:
-        # Обрабатываем результат в зависимости от количества колонок
-        if len(result) >= 3:
-            subscription_end, vless_link, pay_subscribed = result[0], result[1], result[2]
-        elif len(result) == 2:
-            # Если vless_link нет в таблице
-            subscription_end, pay_subscribed = result[0], result[1]
-            vless_link = None
-        else:
-            subscription_end = None
-            vless_link = None
-            pay_subscribed = 0
-        
-        is_active = False
-        
-        # Проверяем, активна ли подписка
-        if pay_subscribed == 1 and subscription_end:
-            try:
-                # Парсим дату окончания
-                if isinstance(subscription_end, str):
-                    # Может быть формат 'YYYY-MM-DD' или 'YYYY-MM-DD HH:MM:SS'
-                    if ' ' in subscription_end:
-                        end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
-                    else:
-                        end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
-                else:
-                    end_date = subscription_end
-                
-                # Проверяем, не истекла ли подписка (сравниваем только даты)
-                today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                end_date_only = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                
-                if end_date_only >= today:
-                    is_active = True
-                    days_remaining = (end_date_only - today).days
-                    end_date_str = end_date.strftime("%d.%m.%Y")
-                else:
-                    days_remaining = 0
-                    end_date_str = None
-            except Exception as e:
-                logger.error(f"Error parsing subscription date: {e}, date: {subscription_end}")
-                is_active = False
-                days_remaining = 0
-                end_date_str = None
-        else:
-            is_active = False
-            days_remaining = 0
-            end_date_str = None
+        subscription_end, vless_link, pay_subscribed = result
     else:
         # Пользователь не найден в базе - используем дефолтные значения
         subscription_end = None
         vless_link = None
         pay_subscribed = 0
-        is_active = False
-        days_remaining = 0
-        end_date_str = None
+
+    is_active, days_remaining, end_date_str = _parse_sub(subscription_end if pay_subscribed == 1 else None)
     
     return {
         'is_active': is_active,
@@ -455,7 +689,6 @@ async def _get_subscription_info(user_id: int):
 
 async def _build_subscription_message(info: dict, state: FSMContext):
     """Строит сообщение и клавиатуру для подписки"""
-    builder = InlineKeyboardBuilder()
     is_active = info['is_active']
     days_remaining = info['days_remaining']
     end_date_str = info['end_date_str']
@@ -504,19 +737,12 @@ async def _build_subscription_message(info: dict, state: FSMContext):
                 f"6 месяцев <s>899₽</s> - 749₽\n"
                 f"12 месяцев <s>1499₽</s> - 1199₽\n\n"
             )
-            for plan_id, plan_data in RENEWAL_PLANS.items():
-                builder.button(
-                    text=f"{plan_data['title']} - {plan_data['price_rub'] // 100}₽ | {plan_data['price_stars']}⭐",
-                    callback_data=f"plan:{plan_id}"
-                )
-            builder.adjust(1)
+            markup = RENEWAL_MARKUP
             await state.set_state(SubscriptionSteps.CHOOSING_PLAN)
         else:
             text += "💡 Ваша подписка активна. Вы сможете продлить её за 3 дня до окончания.\n\n"
+            markup = BACK_MARKUP
             await state.clear()
-        
-        # Кнопка "Назад" всегда
-        builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="go_back"))
     else:
         # Если подписка неактивна или пользователя нет - показываем планы
         text = "💳 <b>Информация о вашем VPN:</b>\n\n"
@@ -528,16 +754,10 @@ async def _build_subscription_message(info: dict, state: FSMContext):
             "• Высокая скорость подключения\n\n"
             "Выберите план подписки:\n"
         )
-        for plan_id, plan_data in SUBSCRIPTION_PLANS.items():
-            builder.button(
-                text=f"{plan_data['title']} - {plan_data['price_rub'] // 100}₽ | {plan_data['price_stars']}⭐",
-                callback_data=f"plan:{plan_id}"
-            )
-        builder.adjust(1)
-        builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="go_back"))
+        markup = PLANS_MARKUP
         await state.set_state(SubscriptionSteps.CHOOSING_PLAN)
     
-    return text, builder
+    return text, markup
 
 @dp.callback_query(F.data == "open_premium")
 async def handle_open_premium_callback(callback: CallbackQuery, state: FSMContext):
@@ -546,11 +766,11 @@ async def handle_open_premium_callback(callback: CallbackQuery, state: FSMContex
     await callback.answer()
     
     info = await _get_subscription_info(user_id)
-    text, builder = await _build_subscription_message(info, state)
+    text, markup = await _build_subscription_message(info, state)
     
     await callback.message.edit_text(
         text,
-        reply_markup=builder.as_markup(),
+        reply_markup=markup,
         parse_mode="HTML"
     )
 
@@ -560,11 +780,11 @@ async def handle_prem_command(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
     info = await _get_subscription_info(user_id)
-    text, builder = await _build_subscription_message(info, state)
+    text, markup = await _build_subscription_message(info, state)
     
     await message.answer(
         text,
-        reply_markup=builder.as_markup(),
+        reply_markup=markup,
         parse_mode="HTML"
     )
 
@@ -572,31 +792,33 @@ async def handle_sub_info(callback: CallbackQuery, state: FSMContext):
     """Обертка для обратной совместимости - вызывает callback обработчик"""
     await handle_open_premium_callback(callback, state)
 
-@dp.callback_query(F.data.startswith("plan:"))
+def _get_active_subscription_end(user_id: int, today: str):
+    """Строка (subscription_end,) активной подписки пользователя или None"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT subscription_end
+            FROM users
+            WHERE user_id = ?
+                AND pay_subscribed = 1
+                AND subscription_end >= ?
+        ''', (user_id, today))
+        return cursor.fetchone()
+
+@dp.callback_query(F.data.startswith(_PFX_PLAN))
 async def select_plan(callback: CallbackQuery, state: FSMContext):
-    plan_id = callback.data.split(":")[1]
+    plan_id = callback.data[len(_PFX_PLAN):]
     user_id = callback.from_user.id
 
-    ALL_PLANS = {**SUBSCRIPTION_PLANS, **RENEWAL_PLANS}
-
-    if plan_id not in ALL_PLANS:
+    plan_data = _ALL_PLANS.get(plan_id)
+    if plan_data is None:
         await callback.answer("❌ Неверный план")
         return
 
-    is_renewal = plan_id in RENEWAL_PLANS
-    plan_data = RENEWAL_PLANS[plan_id] if is_renewal else SUBSCRIPTION_PLANS[plan_id]
+    is_renewal = plan_id in _RENEWAL_IDS
 
     # Проверяем, есть ли у пользователя активная подписка
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT subscription_end 
-            FROM users 
-            WHERE user_id = ? 
-                AND pay_subscribed = 1 
-                AND subscription_end >= DATE('now')
-        ''', (user_id,))
-        active_sub = cursor.fetchone()
+    active_sub = await _run_db(_get_active_subscription_end, user_id, _TODAY.isoformat())
 
     # Если пользователь пытается купить новую подписку, но у него уже есть активная
     if not is_renewal and active_sub:
@@ -612,189 +834,152 @@ async def select_plan(callback: CallbackQuery, state: FSMContext):
             await handle_open_premium_callback(callback, state)
             return
 
-        cursor.execute('''
-            SELECT julianday(subscription_end) - julianday('now') as days_remaining 
-            FROM users 
-            WHERE user_id = ? 
-                AND pay_subscribed = 1 
-                AND subscription_end >= DATE('now')
-        ''', (user_id,))
-        days_result = cursor.fetchone()
-        if days_result and days_result[0] and int(days_result[0]) > 3:
+        # Дата окончания уже получена выше, остаток дней считаем без второго запроса
+        days_remaining = (_parse_date(active_sub[0]) - _TODAY).days
+        if days_remaining > 3:
             await callback.answer("❌ Продление доступно только за 3 дня до окончания подписки!", show_alert=True)
             await handle_open_premium_callback(callback, state)
             return
 
-    # Устанавливаем состояние FSM, если его еще нет
-    current_state = await state.get_state()
-    if current_state is None:
-        await state.set_state(SubscriptionSteps.CHOOSING_PLAN)
-    
+    # Состояние FSM выставляет show_payment_methods, промежуточное CHOOSING_PLAN не нужно
     await state.update_data(
         selected_plan_id=plan_id,
-        selected_plan_data=plan_data,
         is_renewal=is_renewal
     )
     
     # Сразу переходим к выбору метода оплаты (без выбора сервера)
     # Пользователь создаст ключ позже в разделе "Мои ключи"
-    await show_payment_methods(callback, state)
+    await show_payment_methods(callback, state, plan_data)
 
 # Обработчик выбора сервера для подписки больше не используется
 # Пользователь создает ключи в разделе "Мои ключи" после покупки подписки
 
-async def show_payment_methods(callback: CallbackQuery, state: FSMContext):
-    """Показать методы оплаты"""
-    data = await state.get_data()
-    plan_data = data.get('selected_plan_data')
-    
-    builder = InlineKeyboardBuilder()
-    for method_id, method_data in PAYMENT_METHODS.items():
-        builder.button(
-            text=method_data['title'],
-            callback_data=f"method:{method_id}"
-        )
-    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="sub_back_to_plan"))
-    builder.adjust(1)
-
+async def show_payment_methods(callback: CallbackQuery, state: FSMContext, plan_data: Plan):
+    """Показать методы оплаты (план передается напрямую, без повторного чтения FSM)"""
     # Форматируем цены для отображения
-    price_rub = plan_data['price_rub'] // 100
-    price_stars = plan_data['price_stars']
+    price_rub = plan_data.price_rub // 100
+    price_stars = plan_data.price_stars
 
     await callback.message.edit_text(
-        f"📝 Выбранный план: <i>{plan_data['title']}</i>\n"
+        f"📝 Выбранный план: <i>{plan_data.title}</i>\n"
         f"💳 Сумма оплаты: <i>{price_rub}₽</i> или <i>{price_stars}⭐</i>\n\n"
         "Выберите способ оплаты:",
         parse_mode="HTML",
-        reply_markup=builder.as_markup()
+        reply_markup=PAYMENT_METHODS_MARKUP
     )
 
     await state.set_state(SubscriptionSteps.CHOOSING_PAYMENT_METHOD)
 
-@dp.callback_query(SubscriptionSteps.CHOOSING_PAYMENT_METHOD, F.data.startswith("method:"))
+@dp.callback_query(SubscriptionSteps.CHOOSING_PAYMENT_METHOD, F.data.startswith(_PFX_METHOD))
 async def process_payment(callback: CallbackQuery, state: FSMContext):
-    method_id = callback.data.split(":")[1]
+    method_id = callback.data[len(_PFX_METHOD):]
     user_data = await state.get_data()
     plan_id = user_data.get('selected_plan_id')
-    plan_data = user_data.get('selected_plan_data')
 
-    if not all([method_id, plan_id, plan_data]):
+    invoice = _INVOICES.get((plan_id, method_id))
+    if invoice is None:
         await callback.answer("❌ Ошибка данных")
         return
 
-    # Не сохраняем server_id в payload - пользователь создаст ключ позже в разделе "Мои ключи"
-    payload = f"{plan_id}|{method_id}"
-
-    currency_type = 'stars' if PAYMENT_METHODS[method_id]['currency'] == 'XTR' else 'rub'
-    price = plan_data[f"price_{currency_type}"]
-
-    await bot.send_invoice(
-        chat_id=callback.message.chat.id,
-        title=f"VPN подписка - {plan_data['title']}",
-        description=f"Нажимая кнопку «Заплатить» Вы соглашаетесь с правилами VPN бота (/help)",
-        provider_token=PAYMENT_METHODS[method_id]['provider_token'],
-        currency=PAYMENT_METHODS[method_id]['currency'],
-        prices=[LabeledPrice(label="VPN подписка", amount=price)],
-        payload=payload,
-        start_parameter='subscription'
-    )
+    # Счет отправляем в фоне, чтобы сразу ответить на нажатие кнопки
+    _spawn(bot.send_invoice(chat_id=callback.message.chat.id, **invoice))
+    await callback.answer()
 
 @dp.pre_checkout_query()
 async def process_pre_checkout(pre_checkout_query: PreCheckoutQuery):
     await pre_checkout_query.answer(ok=True)
 
+def _save_payment(user_id: int, plan_id: str, is_new_subscription: bool, duration_months: int,
+                  price: int, currency: str, charge_id: str) -> str:
+    """Продлевает подписку и сохраняет платеж одной транзакцией, возвращает новую дату окончания"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+
+        if is_new_subscription:
+            # Новая подписка
+            days = duration_months * 30
+            cursor.execute('''
+                UPDATE users 
+                SET 
+                    pay_subscribed = 1,
+                    subscription_end = DATE('now', 'localtime', '+' || ? || ' days'),
+                    renewal_used = 0
+                WHERE user_id = ?
+                RETURNING subscription_end
+            ''', (days, user_id))
+        else:
+            # Продление существующей подписки
+            cursor.execute('''
+                UPDATE users
+                SET
+                    subscription_end = DATE(subscription_end, ?),
+                    renewal_used = 1
+                WHERE user_id = ?
+                RETURNING subscription_end
+            ''', (f"+{duration_months} months", user_id))
+
+        # Обновленная дата окончания приходит из RETURNING
+        subscription_end = cursor.fetchone()[0]
+
+        # Сохраняем платеж в той же транзакции
+        cursor.execute('''
+            INSERT INTO payments (user_id, amount, currency, plan_id, plan_type, status, telegram_payment_charge_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_id,
+            price,
+            currency,
+            plan_id,
+            'subscription',
+            'completed',
+            charge_id
+        ))
+        
+        conn.commit()
+    return subscription_end
+
 @dp.message(F.successful_payment)
 async def process_successful_payment(message: Message):
     try:
         payload = message.successful_payment.invoice_payload
-        if "|" not in payload:
-            raise ValueError("Неверный формат платежа")
-
-        parts = payload.split("|")
-        if len(parts) < 2:
-            raise ValueError("Неверный формат payload")
-        
-        # Обработка подписки
-        plan_id = parts[0]
-        method_id = parts[1]
+        if "|" in payload:
+            # Счета, выставленные до перехода на индексы: "plan_id|method_id"
+            plan_id, method_id = payload.split("|", 1)
+        else:
+            plan_idx, method_idx = payload.split(":")
+            plan_id = _PLAN_IDS[int(plan_idx)]
+            method_id = _METHOD_IDS[int(method_idx)]
 
         # Определение типа подписки
-        if plan_id in SUBSCRIPTION_PLANS:
-            plan_data = SUBSCRIPTION_PLANS[plan_id]
-            is_new_subscription = True
-        elif plan_id in RENEWAL_PLANS:
-            plan_data = RENEWAL_PLANS[plan_id]
-            is_new_subscription = False
-        else:
+        plan_data = _ALL_PLANS.get(plan_id)
+        if plan_data is None:
             raise ValueError(f"Неизвестный план: {plan_id}")
+        is_new_subscription = plan_id not in _RENEWAL_IDS
 
         # Валидация метода оплаты
         if method_id not in PAYMENT_METHODS:
             raise ValueError(f"Неизвестный метод оплаты: {method_id}")
 
         method_data = PAYMENT_METHODS[method_id]
-        duration_months = plan_data['duration']
-        traffic_gb = plan_data['traffic_gb']
+        price = plan_data.price_by_currency[method_data["currency"]]
+        duration_months = plan_data.duration
+        traffic_gb = plan_data.traffic_gb
 
         user_id = message.from_user.id
         username = message.from_user.username or f"user_{user_id}"
         
         # Обновление подписки в базе данных (БЕЗ создания ключа)
         # Пользователь создаст ключ позже в разделе "Мои ключи"
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-
-            if is_new_subscription:
-                # Новая подписка
-                days = duration_months * 30
-                cursor.execute('''
-                    UPDATE users 
-                    SET 
-                        pay_subscribed = 1,
-                        subscription_end = DATE('now', '+' || ? || ' days'),
-                        renewal_used = 0
-                    WHERE user_id = ?
-                ''', (days, user_id))
-            else:
-                # Продление существующей подписки
-                cursor.execute('''
-                    UPDATE users 
-                    SET 
-                        subscription_end = DATE(subscription_end, ?),
-                        renewal_used = 1
-                    WHERE user_id = ?
-                ''', (f"+{duration_months} months", user_id))
-
-            # Получаем обновленную дату окончания
-            cursor.execute('''
-                SELECT subscription_end FROM users WHERE user_id = ?
-            ''', (user_id,))
-            subscription_end = cursor.fetchone()[0]
-            
-            # Сохраняем платеж
-            cursor.execute('''
-                INSERT INTO payments (user_id, amount, currency, plan_id, plan_type, status, telegram_payment_charge_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                plan_data[f"price_{'stars' if method_data['currency'] == 'XTR' else 'rub'}"],
-                method_data['currency'],
-                plan_id,
-                'subscription',
-                'completed',
-                message.successful_payment.telegram_payment_charge_id
-            ))
-            
-            conn.commit()
+        subscription_end = await _run_db(
+            _save_payment, user_id, plan_id, is_new_subscription, duration_months,
+            price, method_data['currency'], message.successful_payment.telegram_payment_charge_id
+        )
 
         # Форматирование дат
-        activation_date = datetime.now().strftime("%d.%m.%Y")
-        end_date = datetime.strptime(subscription_end, "%Y-%m-%d").strftime("%d.%m.%Y")
+        activation_date = _format_date(_TODAY)
+        end_date = _format_date(_parse_date(subscription_end))
 
         # Форматирование цены
-        price_key = f"price_{'stars' if method_data['currency'] == 'XTR' else 'rub'}"
-        price = plan_data[price_key]
-
         if method_data['currency'] == 'XTR':
             formatted_price = f"{price} Stars (≈ {price * 0.01:.2f}₽)"
         else:
@@ -809,7 +994,7 @@ async def process_successful_payment(message: Message):
             f"Способ оплаты: <i>{method_data['title']}</i>\n"
             f"Сумма оплаты: <i>{formatted_price}</i>\n\n"
             f"<b>Детали подписки</b>:\n"
-            f"• План: <i>{plan_data['title']}</i>\n"
+            f"• План: <i>{plan_data.title}</i>\n"
             f"• Трафик: <i>{traffic_gb} ГБ</i>\n"
             f"• Срок: <i>{duration_months} месяцев</i>\n\n"
             f"✅ Теперь вы можете создать до 3 VPN ключей!\n"
@@ -820,58 +1005,76 @@ async def process_successful_payment(message: Message):
         await message.answer(receipt, parse_mode='HTML')
 
     except Exception as e:
-        logging.error(f"Ошибка обработки платежа: {str(e)}", exc_info=True)
+        logger.error("Ошибка обработки платежа: %s", e, exc_info=True)
         await message.answer(
             "❌ Произошла ошибка при обработке платежа. "
             "Пожалуйста, обратитесь в поддержку."
         )
 
-@dp.callback_query(F.data == "open_invite")
-async def handle_open_invite_callback(callback: CallbackQuery):
-    """Обработчик кнопки Рефералка (callback)"""
-    user_id = callback.from_user.id
-
-    with get_connection(cfg.database.db_path) as conn:
+# Имя бота не меняется за время работы процесса, запрашиваем его один раз
+_BOT_USERNAME: str | None = None
+_BOT_USERNAME_LOCK = asyncio.Lock()
+
+async def get_bot_username() -> str:
+    global _BOT_USERNAME
+    if _BOT_USERNAME is None:
+        async with _BOT_USERNAME_LOCK:
+            if _BOT_USERNAME is None:
+                _BOT_USERNAME = (await bot.get_me()).username
+    return _BOT_USERNAME
+
+def _get_or_create_ref(user_id: int) -> tuple[str, int] | None:
+    """Возвращает (реферальный код, число приглашенных), создавая код при его отсутствии"""
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT referral_code, referral_count 
-            FROM users 
-            WHERE user_id = ?
-        ''', (user_id,))
+        cursor.execute(SQL_GET_USER_REF, (user_id,))
         result = cursor.fetchone()
-
         if not result:
-            await callback.answer("❌ Сначала запустите бота через /start", show_alert=True)
-            return
+            return None
 
         referral_code, referral_count = result
 
         # Если код по какой-то причине отсутствует в БД
         if not referral_code:
-            referral_code = secrets.token_hex(4)
-            cursor.execute('''
-                UPDATE users
-                SET referral_code = ?
-                WHERE user_id = ?
-            ''', (referral_code, user_id))
+            referral_code = next_ref_code()
+            cursor.execute(SQL_SET_USER_REF, (referral_code, user_id))
             conn.commit()
+    return referral_code, referral_count or 0
 
-    bot_username = (await bot.get_me()).username
+def _build_invite_kb(ref_link: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="📤 Поделиться",
+            url=f"https://t.me/share/url?url={ref_link}&text={SHARE_TEXT}"
+        )],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="go_back")]
+    ])
+
+async def _build_invite_view(user_id: int) -> tuple[str, InlineKeyboardMarkup] | None:
+    """Текст и клавиатура реферального раздела; None, если пользователя нет в БД"""
+    ref = await _run_db(_get_or_create_ref, user_id)
+    if ref is None:
+        return None
+    referral_code, referral_count = ref
+
+    bot_username = await get_bot_username()
     ref_link = f"https://t.me/{bot_username}?start=ref_{referral_code}"
     text = (
         f"🎁 <b>Пригласи друга и получи +5 дней VPN!</b>\n\n"
         f"🔗 Ваша реферальная ссылка:\n<code>{ref_link}</code>\n\n"
-        f"👥 Приглашено друзей: <i>{referral_count or 0}</i>\n"
+        f"👥 Приглашено друзей: <i>{referral_count}</i>\n"
         f"За каждого друга вы получаете +5 дней VPN, а друг получает +3 дня!"
     )
+    return text, _build_invite_kb(ref_link)
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text="📤 Поделиться",
-            url=f"https://t.me/share/url?url={ref_link}&text={quote('Присоединяйся к VPN боту с моей подпиской!')}"
-        )],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="go_back")]
-    ])
+@dp.callback_query(F.data == "open_invite")
+async def handle_open_invite_callback(callback: CallbackQuery):
+    """Обработчик кнопки Рефералка (callback)"""
+    view = await _build_invite_view(callback.from_user.id)
+    if view is None:
+        await callback.answer("❌ Сначала запустите бота через /start", show_alert=True)
+        return
+    text, keyboard = view
 
     # Редактируем исходное сообщение с кнопкой
     await callback.message.edit_text(text, parse_mode='HTML', reply_markup=keyboard)
@@ -880,64 +1083,25 @@ async def handle_open_invite_callback(callback: CallbackQuery):
 @dp.message(Command("invite"))
 async def handle_invite_command(message: Message):
     """Обработчик команды /invite"""
-    user_id = message.from_user.id
-
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT referral_code, referral_count 
-            FROM users 
-            WHERE user_id = ?
-        ''', (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
-            await message.answer("❌ Пожалуйста, сначала запустите бота с помощью команды /start")
-            return
-
-        referral_code, referral_count = result
-
-        # Если реферальный код отсутствует, генерируем новый
-        if not referral_code:
-            referral_code = secrets.token_hex(4)
-            cursor.execute('''
-                UPDATE users
-                SET referral_code = ?
-                WHERE user_id = ?
-            ''', (referral_code, user_id))
-            conn.commit()
-
-    bot_username = (await bot.get_me()).username
-    ref_link = f"https://t.me/{bot_username}?start=ref_{referral_code}"
-    text = (
-        f"🎁 <b>Пригласи друга и получи +5 дней VPN!</b>\n\n"
-        f"🔗 Ваша реферальная ссылка:\n<code>{ref_link}</code>\n\n"
-        f"👥 Приглашено друзей: <i>{referral_count or 0}</i>\n"
-        f"За каждого друга вы получаете +5 дней VPN, а друг получает +3 дня!"
-    )
-
-    # Клавиатура с кнопкой поделиться
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text="📤 Поделиться",
-            url=f"https://t.me/share/url?url={ref_link}&text={quote('Присоединяйся к VPN боту с моей подпиской!')}"
-        )],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="go_back")]
-    ])
+    view = await _build_invite_view(message.from_user.id)
+    if view is None:
+        await message.answer("❌ Пожалуйста, сначала запустите бота с помощью команды /start")
+        return
+    text, keyboard = view
 
     await message.answer(text, parse_mode='HTML', reply_markup=keyboard)
 
 @dp.callback_query(F.data == "go_back")
-async def go_back_handler(callback: CallbackQuery):
+async def go_back_handler(callback: CallbackQuery, is_admin: bool):
     """Обработчик кнопки Назад"""
     user_id = callback.from_user.id
     first_name = callback.from_user.first_name or "Пользователь"
-    subscription_status = get_subscription_status(user_id)
+    subscription_status = await _run_db(get_subscription_status, user_id)
 
     await callback.message.edit_text(
         text=get_main_text(first_name, subscription_status, user_id),
         parse_mode='HTML',
-        reply_markup=get_main_keyboard(user_id)
+        reply_markup=get_main_keyboard(is_admin)
     )
     await callback.answer()
 
@@ -948,47 +1112,18 @@ async def handle_sub_back_to_plan(callback: CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data == "open_help")
 @dp.message(Command("help"))
 async def handle_open_help(message_or_callback: Message | CallbackQuery):
+    _, message = _origin(message_or_callback)
     if isinstance(message_or_callback, CallbackQuery):
-        message = message_or_callback.message
         await message_or_callback.answer()
-    else:
-        message = message_or_callback
-    
-    report_button = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="go_back")]
-    ])
-
-    help_text = (
-        "🤖<b>VPN бот</b> — быстрый и надежный VPN сервис\n\n"
-        "<b>Бот предоставляет</b>:\n"
-        "• Быстрый и безопасный VPN\n"
-        "• Обход всех блокировок\n"
-        "• Высокая скорость подключения\n\n"
-        "<b>Как пользоваться</b>?\n"
-        "• Купите подписку через /prem\n"
-        "• Получите VPN ссылку\n"
-        "• Импортируйте ссылку в приложение (v2rayNG, sing-box и т.п.)\n"
-        "• Подключитесь!\n\n"
-        "<b>Реферальная программа</b>:\n"
-        "• Пригласите друга через /invite\n"
-        "• Вы получите +5 дней VPN\n"
-        "• Друг получит +3 дня VPN\n\n"
-        "📌 <b>Команды</b>:\n"
-        "/start - Перезагрузить бота\n"
-        "/prem - Покупка VPN\n"
-        "/invite - Пригласи друга\n"
-    )
-
-    if isinstance(message_or_callback, CallbackQuery):
-        await message_or_callback.message.edit_text(
-            help_text,
-            reply_markup=report_button,
+        await message.edit_text(
+            HELP_TEXT,
+            reply_markup=BACK_MARKUP,
             parse_mode="HTML"
         )
     else:
         await message.answer(
-            help_text,
-            reply_markup=report_button,
+            HELP_TEXT,
+            reply_markup=BACK_MARKUP,
             parse_mode="HTML"
         )
 
@@ -1014,10 +1149,21 @@ async def save_announcement_text(message: Message, state: FSMContext):
     if not new_ann.strip():
         await message.answer("Сообщение не может быть пустым. Попробуйте снова (или отмените командой /start)")
         return
-    set_announcement_text(new_ann)
+    await _run_db(set_announcement_text, new_ann)
     await message.answer("✅ Объявление обновлено! Теперь оно показывается всем пользователям.", parse_mode="HTML")
     await state.clear()
 
+def _select_subscription_row(user_id: int):
+    """Строка (subscription_end, pay_subscribed) пользователя или None"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT subscription_end, pay_subscribed
+            FROM users
+            WHERE user_id = ?
+        ''', (user_id,))
+        return cursor.fetchone()
+
 @dp.callback_query(F.data == "admin_test_reminder")
 async def handle_admin_test_reminder(callback: CallbackQuery):
     """Тест напоминания о подписке для админа"""
@@ -1028,84 +1174,48 @@ async def handle_admin_test_reminder(callback: CallbackQuery):
     user_id = callback.from_user.id
     
     try:
-        # Проверяем подписку админа
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT subscription_end, pay_subscribed
-                FROM users
-                WHERE user_id = ?
-            ''', (user_id,))
-            result = cursor.fetchone()
-            
-            if not result or not result[0]:
-                await callback.answer("❌ У вас нет подписки для теста", show_alert=True)
-                return
-            
-            subscription_end, pay_subscribed = result[0], result[1]
-            
-            if pay_subscribed != 1:
-                await callback.answer("❌ У вас нет активной подписки для теста", show_alert=True)
-                return
-            
-            # Парсим дату окончания
-            try:
-                if isinstance(subscription_end, str):
-                    if ' ' in subscription_end:
-                        end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
-                    else:
-                        end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
-                else:
-                    end_date = subscription_end
-                
-                # Вычисляем количество дней до окончания
-                days_remaining = (end_date - datetime.now()).days
-                days_display = "&lt;1" if days_remaining < 1 else str(days_remaining)
-                
-                if days_remaining > 3:
-                    # В callback.answer не используем HTML, поэтому заменяем &lt; на <
-                    days_display_plain = "<1" if days_remaining < 1 else str(days_remaining)
-                    await callback.answer(
-                        f"ℹ️ У вас осталось {days_display_plain} дней до окончания подписки. "
-                        "Напоминание отправляется только если осталось 3 дня или меньше.",
-                        show_alert=True
-                    )
-                    return
-                
-                # Форматируем дату окончания
-                end_date_str = end_date.strftime("%d.%m.%Y")
-                
-                # Формируем кнопки для продления подписки (как в меню премиум при остатке <= 3 дней)
-                builder = InlineKeyboardBuilder()
-                for plan_id, plan_data in RENEWAL_PLANS.items():
-                    builder.button(
-                        text=f"{plan_data['title']} - {plan_data['price_rub'] // 100}₽ | {plan_data['price_stars']}⭐",
-                        callback_data=f"plan:{plan_id}"
-                    )
-                builder.adjust(1)
-                builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="go_back"))
-                
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "⏰ <b>Напоминание о подписке</b>\n\n"
-                        f"Ваша VPN подписка истекает <b>через {days_display} дней</b> ({end_date_str})\n\n"
-                        "🔥 <b>Сейчас действует скидка!</b>\n"
-                        "Успей продлить подписку сейчас и получи выгодную цену.\n\n"
-                        "Не упусти возможность продолжить пользоваться VPN по специальной цене! 🎁"
-                    ),
-                    reply_markup=builder.as_markup(),
-                    parse_mode="HTML"
+        # Проверяем подписку админа (запрос в пуле БД, до обращений к Telegram)
+        result = await _run_db(_select_subscription_row, user_id)
+
+        if not result or not result[0]:
+            await callback.answer("❌ У вас нет подписки для теста", show_alert=True)
+            return
+
+        subscription_end, pay_subscribed = result[0], result[1]
+
+        if pay_subscribed != 1:
+            await callback.answer("❌ У вас нет активной подписки для теста", show_alert=True)
+            return
+
+        # Парсим дату окончания
+        try:
+            days_remaining, text = _reminder_text(_parse_date(subscription_end))
+
+            if days_remaining > 3:
+                # В callback.answer не используем HTML, поэтому заменяем &lt; на <
+                days_display_plain = "<1" if days_remaining < 1 else str(days_remaining)
+                await callback.answer(
+                    f"ℹ️ У вас осталось {days_display_plain} дней до окончания подписки. "
+                    "Напоминание отправляется только если осталось 3 дня или меньше.",
+                    show_alert=True
                 )
-                
-                await callback.answer("✅ Тестовое напоминание отправлено!")
-                
-            except Exception as e:
-                logger.error(f"Error parsing subscription date: {e}")
-                await callback.answer("❌ Ошибка при проверке подписки", show_alert=True)
-    
+                return
+
+            await bot.send_message(
+                chat_id=user_id,
+                text=text,
+                reply_markup=RENEWAL_MARKUP,
+                parse_mode="HTML"
+            )
+
+            await callback.answer("✅ Тестовое напоминание отправлено!")
+
+        except Exception as e:
+            logger.error("Error parsing subscription date: %s", e)
+            await callback.answer("❌ Ошибка при проверке подписки", show_alert=True)
+
     except Exception as e:
-        logger.error(f"Error in admin_test_reminder: {e}")
+        logger.error("Error in admin_test_reminder: %s", e)
         await callback.answer("❌ Ошибка при отправке тестового напоминания", show_alert=True)
 
 @dp.callback_query(F.data == "admin_test_feedback")
@@ -1123,6 +1233,28 @@ async def handle_admin_test_feedback(callback: CallbackQuery, state: FSMContext)
     await state.set_state(AdminEditStates.TEST_FEEDBACK_USERNAME)
     await callback.answer()
 
+def _find_feedback_target(username: str):
+    """(user_id, first_name, username, ID последнего платежа или 0) пользователя по username"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, first_name, username
+            FROM users
+            WHERE username = ? OR username = ?
+        ''', (username, f"@{username}"))
+        user_data = cursor.fetchone()
+        if not user_data:
+            return None
+        
+        # Получаем последний платеж пользователя (или создаем фиктивный ID)
+        cursor.execute('''
+            SELECT id FROM payments
+            WHERE user_id = ? AND status = 'completed'
+            ORDER BY id DESC LIMIT 1
+        ''', (user_data[0],))
+        payment_result = cursor.fetchone()
+        return (*user_data, payment_result[0] if payment_result else 0)
+
 @dp.message(AdminEditStates.TEST_FEEDBACK_USERNAME)
 async def handle_test_feedback_username(message: Message, state: FSMContext):
     """Обработка username для тестового опроса"""
@@ -1138,168 +1270,203 @@ async def handle_test_feedback_username(message: Message, state: FSMContext):
         username = username[1:]
     
     try:
-        # Ищем пользователя по username
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, first_name, username
-                FROM users
-                WHERE username = ? OR username = ?
-            ''', (username, f"@{username}"))
-            user_data = cursor.fetchone()
-            
-            if not user_data:
-                await message.answer(
-                    f"❌ Пользователь с username <code>@{username}</code> не найден в базе данных.",
-                    parse_mode="HTML"
-                )
-                await state.clear()
-                return
-            
-            target_user_id, first_name, db_username = user_data
-            
-            # Получаем последний платеж пользователя (или создаем фиктивный ID)
-            cursor.execute('''
-                SELECT id FROM payments
-                WHERE user_id = ? AND status = 'completed'
-                ORDER BY id DESC LIMIT 1
-            ''', (target_user_id,))
-            payment_result = cursor.fetchone()
-            payment_id = payment_result[0] if payment_result else 0
-            
-            # Отправляем опрос - кнопки в строку с цифрами 1-5 и звездами
-            builder = InlineKeyboardBuilder()
-            buttons = []
-            for rating in range(1, 6):
-                buttons.append(InlineKeyboardButton(
-                    text=f"{rating} ⭐️",
-                    callback_data=f"feedback_rating:{rating}:{payment_id}"
-                ))
-            builder.row(*buttons)
-            
-            await bot.send_message(
-                chat_id=target_user_id,
-                text=(
-                    "👋 Привет! Как тебе наш VPN?\n\n"
-                    "Поделись своим мнением, это поможет нам стать лучше!"
-                ),
-                reply_markup=builder.as_markup(),
-                parse_mode="HTML"
-            )
-            
+        # Ищем пользователя по username и его последний платеж
+        user_data = await _run_db(_find_feedback_target, username)
+        
+        if not user_data:
             await message.answer(
-                f"✅ Тестовый опрос отправлен пользователю <b>{first_name}</b> (@{db_username or username})",
+                f"❌ Пользователь с username <code>@{username}</code> не найден в базе данных.",
                 parse_mode="HTML"
             )
             await state.clear()
-    
+            return
+        
+        target_user_id, first_name, db_username, payment_id = user_data
+
+        # Отправляем опрос - кнопки в строку с цифрами 1-5 и звездами
+        builder = InlineKeyboardBuilder()
+        buttons = []
+        for rating in range(1, 6):
+            buttons.append(InlineKeyboardButton(
+                text=f"{rating} ⭐️",
+                callback_data=f"feedback_rating:{rating}:{payment_id}"
+            ))
+        builder.row(*buttons)
+
+        await bot.send_message(
+            chat_id=target_user_id,
+            text=(
+                "👋 Привет! Как тебе наш VPN?\n\n"
+                "Поделись своим мнением, это поможет нам стать лучше!"
+            ),
+            reply_markup=builder.as_markup(),
+            parse_mode="HTML"
+        )
+
+        await message.answer(
+            f"✅ Тестовый опрос отправлен пользователю <b>{first_name}</b> (@{db_username or username})",
+            parse_mode="HTML"
+        )
+        await state.clear()
+
     except Exception as e:
-        logger.error(f"Error sending test feedback: {e}")
+        logger.error("Error sending test feedback: %s", e)
         await message.answer(
             f"❌ Ошибка при отправке тестового опроса: {str(e)}",
             parse_mode="HTML"
         )
         await state.clear()
 
+_ADMIN_IDS = frozenset(cfg.bot.admin_ids)
+
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь админом"""
-    return user_id in cfg.bot.admin_ids
+    return user_id in _ADMIN_IDS
+
+@dataclass(slots=True, frozen=True)
+class Server:
+    """Данные сервера 3x-ui; строка из SQL_SERVER_BY_ID/SQL_ACTIVE_SERVERS"""
+    id: int
+    name: str
+    ip: str
+    username: str | None
+    password: str | None
+    inbound_id: int
+    base_url: str
+
+# Список активных серверов меняется только админскими командами, поэтому храним его
+# и готовую клавиатуру до следующего изменения. TTL страхует от правок в обход бота.
+# Кэш читается и меняется только в цикле событий; в пуле БД выполняются лишь SELECT
+_SERVERS_CACHE_TTL = 30
+_ACTIVE_SERVERS_CACHE: list[Server] | None = None
+_ACTIVE_SERVERS_BY_ID: dict[int, Server] = {}
+_ACTIVE_SERVERS_CACHED_AT = 0.0
+# Растет при каждом сбросе: выборка, начатая до сброса, не попадет в кэш
+_SERVERS_CACHE_GENERATION = 0
+# Клавиатура вместе со списком серверов, по которому она построена
+_SERVER_KB_CACHE: tuple[list[Server], InlineKeyboardMarkup] | None = None
+
+def invalidate_servers_cache():
+    """Сбрасывает кэш серверов после добавления, переключения или удаления"""
+    global _ACTIVE_SERVERS_CACHE, _ACTIVE_SERVERS_BY_ID, _SERVERS_CACHE_GENERATION
+    _ACTIVE_SERVERS_CACHE = None
+    _ACTIVE_SERVERS_BY_ID = {}
+    _SERVERS_CACHE_GENERATION += 1
+
+def get_active_servers() -> list[Server]:
+    """Получить список активных серверов из БД (без кэша)"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQL_ACTIVE_SERVERS)
+        return [Server(*row) for row in cursor.fetchall()]
+
+async def active_servers() -> list[Server]:
+    """Активные серверы для обработчиков: свежий кэш отдаем сразу, без перехода в пул БД"""
+    global _ACTIVE_SERVERS_CACHE, _ACTIVE_SERVERS_BY_ID, _ACTIVE_SERVERS_CACHED_AT
+    while True:
+        if _ACTIVE_SERVERS_CACHE is not None and time.monotonic() - _ACTIVE_SERVERS_CACHED_AT < _SERVERS_CACHE_TTL:
+            return _ACTIVE_SERVERS_CACHE
+        generation = _SERVERS_CACHE_GENERATION
+        servers = await _run_db(get_active_servers)
+        if generation == _SERVERS_CACHE_GENERATION:
+            _ACTIVE_SERVERS_CACHE = servers
+            _ACTIVE_SERVERS_BY_ID = {server.id: server for server in servers}
+            _ACTIVE_SERVERS_CACHED_AT = time.monotonic()
+            return servers
+        # Кэш сбросили, пока шла выборка: строки могли устареть, выбираем заново
+
+def get_server_keyboard(servers: list[Server]) -> InlineKeyboardMarkup:
+    """Клавиатура выбора сервера для нового ключа по списку из active_servers()"""
+    global _SERVER_KB_CACHE
+    # Пересобираем клавиатуру только при изменении списка серверов
+    if _SERVER_KB_CACHE is None or _SERVER_KB_CACHE[0] != servers:
+        builder = InlineKeyboardBuilder()
+        for server in servers:
+            builder.row(InlineKeyboardButton(
+                text=f"🖥️ {server.name}",
+                callback_data=f"key_server:{server.id}"
+            ))
+        builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="manage_keys"))
+        _SERVER_KB_CACHE = (servers, builder.as_markup())
+    return _SERVER_KB_CACHE[1]
 
-def get_active_servers():
-    """Получить список активных серверов"""
-    with get_connection(cfg.database.db_path) as conn:
+def _select_server_by_id(server_id: int) -> Server | None:
+    """Сервер по ID из БД, в том числе отключенный"""
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, ip, inbound_id 
-            FROM servers 
-            WHERE is_active = TRUE
-            ORDER BY name
-        ''')
-        return cursor.fetchall()
+        cursor.execute(SQL_SERVER_BY_ID, (server_id,))
+        row = cursor.fetchone()
+    return Server(*row) if row else None
 
-def get_server_by_id(server_id: int):
+async def get_server_by_id(server_id: int) -> Server | None:
     """Получить данные сервера по ID"""
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, ip, username, password, inbound_id, base_url
-            FROM servers 
-            WHERE id = ?
-        ''', (server_id,))
-        return cursor.fetchone()
+    # Активные серверы берем из кэша, в БД идем только за отключенными
+    await active_servers()
+    server = _ACTIVE_SERVERS_BY_ID.get(server_id)
+    if server is not None:
+        return server
+    return await _run_db(_select_server_by_id, server_id)
+
+# Клиенты панелей по ID сервера: httpx.AsyncClient держит соединения и cookie сессии,
+# поэтому TLS-рукопожатие и логин не повторяются на каждый ключ
+_XUI_CLIENTS: dict[int, tuple[tuple, XUIClient]] = {}
+
+def get_xui_client(server: Server) -> XUIClient:
+    """Клиент панели сервера; пересоздается, только если изменились данные подключения"""
+    params = (server.base_url, server.username, server.password, server.inbound_id)
+    cached = _XUI_CLIENTS.get(server.id)
+    if cached is not None:
+        if cached[0] == params:
+            return cached[1]
+        _spawn(cached[1].aclose())
+    client = XUIClient(
+        base_url=server.base_url,
+        username=server.username,
+        password=server.password,
+        inbound_id=server.inbound_id
+    )
+    _XUI_CLIENTS[server.id] = (params, client)
+    return client
 
-def check_user_subscription(user_id: int) -> bool:
-    """Проверка, есть ли у пользователя активная подписка"""
-    try:
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT pay_subscribed, subscription_end 
-                FROM users 
-                WHERE user_id = ?
-            ''', (user_id,))
-            result = cursor.fetchone()
-            if not result or result[0] != 1:
-                return False
-            if result[1]:
-                try:
-                    subscription_end = result[1]
-                    # Парсим дату с учетом возможного формата с временем
-                    if isinstance(subscription_end, str):
-                        if ' ' in subscription_end:
-                            end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
-                        else:
-                            end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
-                    else:
-                        end_date = subscription_end
-                    
-                    # Сравниваем только даты
-                    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-                    end_date_only = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                    return end_date_only >= today
-                except Exception as e:
-                    logger.error(f"Error parsing subscription date in check_user_subscription: {e}, date: {result[1]}")
-                    return False
-            return False
-    except Exception as e:
-        logger.error(f"Error in check_user_subscription: {e}")
-        return False
+# Сколько ждем ответа панели на вход или удаление клиента; httpx сам ждет до 20 с,
+# но недоступная панель не должна держать обработчик так долго
+_XUI_CALL_TIMEOUT = 10
 
-def get_user_keys_count(user_id: int) -> int:
-    """Получить количество активных ключей пользователя"""
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) FROM vpn_keys 
-            WHERE user_id = ? AND is_active = TRUE
-        ''', (user_id,))
-        return cursor.fetchone()[0]
+async def _xui_call(func, *args, **kwargs):
+    """Выполняет вызов XUIClient с ограничением времени ожидания"""
+    try:
+        return await asyncio.wait_for(func(*args, **kwargs), _XUI_CALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"x-ui panel did not respond within {_XUI_CALL_TIMEOUT} s") from None
+
+def get_subscription_and_keys_count(user_id: int) -> tuple[bool, int]:
+    """Активна ли подписка и сколько у пользователя активных ключей (одним запросом)"""
+    with get_connection(_DB_PATH) as conn:
+        result = conn.execute(SQL_SUB_AND_KEYS_COUNT, (user_id,)).fetchone()
+    if not result:
+        return False, 0
+    return bool(result[0]), result[1]
+
+def get_subscription_and_has_keys(user_id: int) -> tuple[bool, bool]:
+    """Активна ли подписка и есть ли у пользователя хотя бы один ключ (одним запросом)"""
+    with get_connection(_DB_PATH) as conn:
+        result = conn.execute(SQL_SUB_AND_HAS_KEYS, (user_id,)).fetchone()
+    if not result:
+        return False, False
+    return bool(result[0]), bool(result[1])
 
 def get_user_keys(user_id: int):
     """Получить список всех ключей пользователя"""
-    with get_connection(cfg.database.db_path) as conn:
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT k.id, k.key_name, k.vless_link, k.created_at, k.expires_at, 
-                   k.traffic_gb, k.is_active, s.name as server_name
-            FROM vpn_keys k
-            LEFT JOIN servers s ON k.server_id = s.id
-            WHERE k.user_id = ?
-            ORDER BY k.created_at DESC
-        ''', (user_id,))
+        cursor.execute(SQL_USER_KEYS, (user_id,))
         return cursor.fetchall()
 
 def get_key_by_id(key_id: int, user_id: int):
     """Получить информацию о ключе по ID"""
-    with get_connection(cfg.database.db_path) as conn:
+    with get_connection(_DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT k.id, k.key_name, k.vless_link, k.vless_client_id, k.created_at, 
-                   k.expires_at, k.traffic_gb, k.is_active, k.server_id, s.name as server_name
-            FROM vpn_keys k
-            LEFT JOIN servers s ON k.server_id = s.id
-            WHERE k.id = ? AND k.user_id = ?
-        ''', (key_id, user_id))
+        cursor.execute(SQL_KEY_BY_ID, (key_id, user_id))
         return cursor.fetchone()
 
 # ==================== УПРАВЛЕНИЕ КЛЮЧАМИ ====================
@@ -1309,13 +1476,15 @@ async def handle_manage_keys(callback: CallbackQuery):
     """Обработчик раздела управления ключами"""
     user_id = callback.from_user.id
     
-    # Проверяем подписку
-    if not check_user_subscription(user_id):
+    # Проверяем подписку и наличие ключей; у пользователя без ключей список не запрашиваем
+    has_subscription, has_keys = await _run_db(get_subscription_and_has_keys, user_id)
+    if not has_subscription:
         await callback.answer("❌ У вас нет активной подписки. Купите подписку через /prem", show_alert=True)
         return
     
-    keys = get_user_keys(user_id)
-    keys_count = get_user_keys_count(user_id)
+    keys = await _run_db(get_user_keys, user_id) if has_keys else []
+    # Число активных ключей считаем по уже полученному списку (is_active - 7-е поле)
+    keys_count = sum(1 for key in keys if key[6])
     
     text = (
         f"🔑 <b>Мои VPN ключи</b>\n\n"
@@ -1353,17 +1522,15 @@ async def handle_create_key(callback: CallbackQuery, state: FSMContext):
     """Обработчик создания нового ключа"""
     user_id = callback.from_user.id
     
-    # Проверяем подписку
-    if not check_user_subscription(user_id):
+    # Проверяем подписку и лимит ключей одним запросом
+    has_subscription, keys_count = await _run_db(get_subscription_and_keys_count, user_id)
+    if not has_subscription:
         await callback.answer("❌ У вас нет активной подписки", show_alert=True)
         return
     
-    # Проверяем лимит ключей
-    keys_count = get_user_keys_count(user_id)
-    
     # Если лимит превышен, показываем список ключей для замены
     if keys_count >= 3:
-        keys = get_user_keys(user_id)
+        keys = await _run_db(get_user_keys, user_id)
         if not keys:
             await callback.answer("❌ Ошибка: ключи не найдены", show_alert=True)
             return
@@ -1388,99 +1555,126 @@ async def handle_create_key(callback: CallbackQuery, state: FSMContext):
         return
     
     # Получаем список активных серверов
-    active_servers = get_active_servers()
-    if not active_servers:
+    servers = await active_servers()
+    if not servers:
         await callback.answer("❌ Нет доступных серверов", show_alert=True)
         return
     
-    # Формируем клавиатуру с серверами
-    builder = InlineKeyboardBuilder()
-    for server_id, server_name, server_ip, inbound_id in active_servers:
-        builder.row(InlineKeyboardButton(
-            text=f"🖥️ {server_name}",
-            callback_data=f"key_server:{server_id}"
-        ))
-    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="manage_keys"))
-    
     await callback.message.edit_text(
         "🔑 <b>Создание нового ключа</b>\n\n"
         "Выберите сервер для создания ключа:",
         parse_mode="HTML",
-        reply_markup=builder.as_markup()
+        reply_markup=get_server_keyboard(servers)
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("key_server:"))
+async def _delete_remote_client(server_id: int, vless_client_id: str):
+    """Удаляет клиента с сервера; ошибки только логируются"""
+    server = await get_server_by_id(server_id)
+    if not server:
+        return
+    try:
+        server_client = get_xui_client(server)
+        await _xui_call(server_client.delete_client, vless_client_id)
+        logger.info("Successfully deleted client %s from server %s", vless_client_id, server_id)
+    except Exception as e:
+        logger.error("Failed to delete client from server: %s", e)
+
+def _delete_key_row(key_id: int, user_id: int):
+    """Удаляет ключ пользователя из БД"""
+    with get_connection(_DB_PATH) as conn:
+        conn.execute('DELETE FROM vpn_keys WHERE id = ? AND user_id = ?', (key_id, user_id))
+
+def _get_subscription_end(user_id: int):
+    """Дата окончания подписки и остаток дней"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        # Остаток дней считает SQLite, дату разбираем только для срока ключа
+        cursor.execute('''
+            SELECT subscription_end,
+                   CAST(julianday(subscription_end) - julianday('now', 'localtime') AS INTEGER)
+            FROM users WHERE user_id = ?
+        ''', (user_id,))
+        return cursor.fetchone()
+
+def _save_key(user_id: int, server: Server, vless_client_id: str, vless_link: str,
+              expires_at: str, traffic_gb: int, old_key_id: int | None) -> str:
+    """Сохраняет новый ключ (и удаляет заменяемый) и возвращает его название"""
+    # Новый ключ, его название и удаление старого - одна транзакция и один commit
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO vpn_keys (user_id, server_id, vless_client_id, vless_link, 
+                                key_name, expires_at, traffic_gb, is_active)
+            VALUES (?, ?, ?, ?, NULL, ?, ?, TRUE)
+            RETURNING id
+        ''', (user_id, server.id, vless_client_id, vless_link, expires_at, traffic_gb))
+        key_id = cursor.fetchone()[0]
+        # Название содержит id ключа, который известен только после вставки
+        key_name = f"{server.name} #{key_id}"
+        cursor.execute('UPDATE vpn_keys SET key_name = ? WHERE id = ?', (key_name, key_id))
+        if old_key_id:
+            cursor.execute('DELETE FROM vpn_keys WHERE id = ? AND user_id = ?', (old_key_id, user_id))
+    return key_name
+
+@dp.callback_query(F.data.startswith(_PFX_KEY_SERVER))
 async def handle_key_server_selection(callback: CallbackQuery, state: FSMContext):
     """Обработчик выбора сервера для ключа"""
-    server_id = int(callback.data.split(":")[1])
+    server_id = int(callback.data[len(_PFX_KEY_SERVER):])
     await state.update_data(selected_server_id=server_id)
-    
+    await _create_key(callback, state, server_id)
+
+async def _create_key(callback: CallbackQuery, state: FSMContext, server_id: int):
+    """Создает ключ на выбранном сервере (или заменяет ключ из key_to_replace)"""
     # Сразу создаем ключ без запроса названия
     user_id = callback.from_user.id
     key_to_replace = (await state.get_data()).get('key_to_replace')
     
-    # Получаем данные сервера
-    server_data = get_server_by_id(server_id)
-    if not server_data:
+    # Сервер, подписка и заменяемый ключ не зависят друг от друга - читаем их параллельно
+    reads = [get_server_by_id(server_id), _run_db(_get_subscription_end, user_id)]
+    if key_to_replace:
+        reads.append(_run_db(get_key_by_id, key_to_replace, user_id))
+    server, result, *old_key = await asyncio.gather(*reads)
+    old_key_data = old_key[0] if old_key else None
+    if not server:
         await callback.answer("❌ Сервер не найден", show_alert=True)
         await state.clear()
         return
     
-    # Распаковываем данные сервера
-    if len(server_data) >= 7:
-        server_id_db, server_name, server_ip, server_username, server_password, server_inbound_id, server_base_url = server_data
-    else:
-        await callback.answer("❌ Ошибка данных сервера", show_alert=True)
+    # Информация о подписке нужна для определения трафика и срока
+    if not result or not result[0]:
+        await callback.answer("❌ Ошибка: подписка не найдена", show_alert=True)
         await state.clear()
         return
     
-    # Получаем информацию о подписке для определения трафика и срока
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT subscription_end FROM users WHERE user_id = ?
-        ''', (user_id,))
-        result = cursor.fetchone()
-        if not result or not result[0]:
-            await callback.answer("❌ Ошибка: подписка не найдена", show_alert=True)
+    subscription_end, days_valid = result
+    try:
+        end_date = _parse_date(subscription_end)
+        if days_valid is None or days_valid <= 0:
+            await callback.answer("❌ Ваша подписка истекла", show_alert=True)
             await state.clear()
             return
         
-        subscription_end = result[0]
-        try:
-            end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
-            days_valid = (end_date - datetime.now()).days
-            if days_valid <= 0:
-                await callback.answer("❌ Ваша подписка истекла", show_alert=True)
-                await state.clear()
-                return
-            
-            # Вычисляем expiry_time в миллисекундах (unix timestamp * 1000)
-            # Устанавливаем время окончания на конец дня (23:59:59)
-            from datetime import time as dt_time
-            end_datetime = datetime.combine(end_date.date(), dt_time(23, 59, 59))
-            expiry_time_unix_ms = int(end_datetime.timestamp() * 1000)
-        except Exception as e:
-            await callback.answer("❌ Ошибка при расчете срока подписки", show_alert=True)
-            await state.clear()
-            return
+        # Вычисляем expiry_time в миллисекундах (unix timestamp * 1000)
+        # Устанавливаем время окончания на конец дня (23:59:59)
+        from datetime import time as dt_time
+        end_datetime = datetime.combine(end_date, dt_time(23, 59, 59))
+        expiry_time_unix_ms = int(end_datetime.timestamp() * 1000)
+    except Exception as e:
+        await callback.answer("❌ Ошибка при расчете срока подписки", show_alert=True)
+        await state.clear()
+        return
     
     # Создаем ключ на сервере
     try:
-        server_client = XUIClient(
-            base_url=server_base_url,
-            username=server_username,
-            password=server_password,
-            inbound_id=server_inbound_id
-        )
+        server_client = get_xui_client(server)
         
         # Используем стандартные значения для трафика (можно настроить)
         traffic_gb = 100  # Можно брать из подписки
         
         # Создаем клиента с display_name = server_id (в конце VLESS ссылки будет server_id)
         # Передаем expiry_time_unix_ms, чтобы ключ истекал в тот же день, что и подписка
-        result = server_client.add_vless_client(
+        result = await server_client.add_vless_client(
             telegram_user_id=user_id,
             display_name=str(server_id),  # В конце VLESS ссылки будет server_id
             traffic_gb=traffic_gb,
@@ -1490,84 +1684,39 @@ async def handle_key_server_selection(callback: CallbackQuery, state: FSMContext
         vless_client_id = result.get("id")
         vless_link = result.get("link")
         
-        # Сохраняем ключ в БД (key_name будет обновлен после получения key_id)
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-            expires_at = end_date.strftime("%Y-%m-%d")
-            cursor.execute('''
-                INSERT INTO vpn_keys (user_id, server_id, vless_client_id, vless_link, 
-                                    key_name, expires_at, traffic_gb, is_active)
-                VALUES (?, ?, ?, ?, ?, ?, ?, TRUE)
-            ''', (user_id, server_id, vless_client_id, vless_link, None, expires_at, traffic_gb))
-            conn.commit()
-            key_id = cursor.lastrowid
-        
-        # Обновляем key_name и vless_link с правильными значениями
-        key_name = f"{server_name} #{key_id}"
-        # Обновляем VLESS ссылку: заменяем последнюю часть (после #) на server_id
+        # Заменяем последнюю часть VLESS ссылки (после #) на server_id до записи в БД
         if '#' in vless_link:
             vless_link = vless_link.rsplit('#', 1)[0] + f"#{server_id}"
         else:
             vless_link = vless_link + f"#{server_id}"
-        
-        # Обновляем запись в БД с правильным key_name и vless_link
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE vpn_keys 
-                SET key_name = ?, vless_link = ?
-                WHERE id = ?
-            ''', (key_name, vless_link, key_id))
-            conn.commit()
-        
-        # Если это замена ключа, удаляем старый
-        if key_to_replace:
-            old_key_data = get_key_by_id(key_to_replace, user_id)
-            if old_key_data:
-                old_key_id_db, old_key_name, old_vless_link, old_vless_client_id, old_created_at, old_expires_at, old_traffic_gb, old_is_active, old_server_id, old_server_name = old_key_data
-                
-                # Удаляем старый ключ из БД
-                with get_connection(cfg.database.db_path) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('DELETE FROM vpn_keys WHERE id = ? AND user_id = ?', (key_to_replace, user_id))
-                    conn.commit()
-                
-                # Удаляем старый клиент с сервера
-                old_server_data = get_server_by_id(old_server_id)
-                if old_server_data:
-                    old_server_id_db, old_server_name, old_server_ip, old_server_username, old_server_password, old_server_inbound_id, old_server_base_url = old_server_data
-                    try:
-                        old_server_client = XUIClient(
-                            base_url=old_server_base_url,
-                            username=old_server_username,
-                            password=old_server_password,
-                            inbound_id=old_server_inbound_id
-                        )
-                        old_server_client.delete_client(old_vless_client_id)
-                        logger.info(f"Successfully deleted old client {old_vless_client_id} from server {old_server_id}")
-                    except Exception as e:
-                        logger.error(f"Failed to delete old client from server: {e}")
-                        # Продолжаем работу даже если не удалось удалить старый клиент
-        
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="go_back"))
+
+        # Если это замена ключа, старый удаляем в той же транзакции
+        key_name = await _run_db(
+            _save_key, user_id, server, vless_client_id, vless_link, end_date.isoformat(), traffic_gb,
+            key_to_replace if old_key_data else None
+        )
+
+        if old_key_data:
+            # Старый клиент удаляем с сервера в фоне, ответ пользователю его не ждет
+            old_vless_client_id, old_server_id = old_key_data[3], old_key_data[8]
+            _spawn(_delete_remote_client(old_server_id, old_vless_client_id))
         
         await callback.message.edit_text(
             f"✅ <b>Ключ успешно {'заменен' if key_to_replace else 'создан'}!</b>\n\n"
             f"<b>Информация:</b>\n"
             f"Название: <i>{key_name}</i>\n"
-            f"Сервер: <i>{server_name}</i>\n"
-            f"Срок действия: <i>{end_date.strftime('%d.%m.%Y')}</i>\n\n"
+            f"Сервер: <i>{server.name}</i>\n"
+            f"Срок действия: <i>{_format_date(end_date)}</i>\n\n"
             f"🔗 <b>VPN ссылка:</b>\n"
             f"<code>{vless_link}</code>\n\n"
             f"Используйте раздел <b>🔑 Мои ключи</b> для управления ключами.",
             parse_mode="HTML",
-            reply_markup=builder.as_markup()
+            reply_markup=BACK_MARKUP
         )
         await callback.answer()
         
     except Exception as e:
-        logger.error(f"Failed to create key: {e}")
+        logger.error("Failed to create key: %s", e)
         await callback.message.edit_text(
             f"❌ <b>Ошибка при создании ключа:</b>\n<code>{str(e)}</code>\n\n"
             f"Попробуйте позже или обратитесь в поддержку.",
@@ -1577,18 +1726,11 @@ async def handle_key_server_selection(callback: CallbackQuery, state: FSMContext
     
     await state.clear()
 
-@dp.message(KeyManagementStates.ENTERING_KEY_NAME)
-async def handle_key_name_input(message: Message, state: FSMContext):
-    """Обработка названия ключа - больше не используется, но оставляем для совместимости"""
-    # Эта функция больше не используется, так как мы сразу создаем ключ после выбора сервера
-    await message.answer("❌ Эта функция больше не используется. Выберите сервер заново через раздел '🔑 Мои ключи'.")
-    await state.clear()
-
 @dp.callback_query(F.data == "view_key_list")
 async def handle_view_key_list(callback: CallbackQuery):
     """Показать список ключей для просмотра"""
     user_id = callback.from_user.id
-    keys = get_user_keys(user_id)
+    keys = await _run_db(get_user_keys, user_id)
     
     if not keys:
         await callback.answer("У вас нет ключей", show_alert=True)
@@ -1610,13 +1752,13 @@ async def handle_view_key_list(callback: CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("view_key:"))
+@dp.callback_query(F.data.startswith(_PFX_VIEW_KEY))
 async def handle_view_key(callback: CallbackQuery):
     """Просмотр информации о ключе"""
     user_id = callback.from_user.id
-    key_id = int(callback.data.split(":")[1])
+    key_id = int(callback.data[len(_PFX_VIEW_KEY):])
     
-    key_data = get_key_by_id(key_id, user_id)
+    key_data = await _run_db(get_key_by_id, key_id, user_id)
     if not key_data:
         await callback.answer("❌ Ключ не найден", show_alert=True)
         return
@@ -1626,46 +1768,35 @@ async def handle_view_key(callback: CallbackQuery):
     status = "✅ Активен" if is_active else "❌ Неактивен"
     name = key_name or f"Ключ #{key_id_db}"
     
-    text = (
+    parts = [
         f"🔑 <b>{name}</b>\n\n"
         f"Статус: <i>{status}</i>\n"
         f"Сервер: <i>{server_name or 'Неизвестно'}</i>\n"
-    )
+    ]
     
+    # Даты хранятся в ISO-формате, поэтому форматируем их срезами без strptime
     if created_at:
-        try:
-            created = datetime.strptime(created_at.split()[0], "%Y-%m-%d").strftime("%d.%m.%Y")
-            text += f"Создан: <i>{created}</i>\n"
-        except:
-            pass
+        parts.append(f"Создан: <i>{_iso_to_ddmmyyyy(created_at)}</i>\n")
     
     if expires_at:
-        try:
-            expires = datetime.strptime(expires_at, "%Y-%m-%d").strftime("%d.%m.%Y")
-            text += f"Истекает: <i>{expires}</i>\n"
-        except:
-            pass
+        parts.append(f"Истекает: <i>{_iso_to_ddmmyyyy(expires_at)}</i>\n")
     
     if traffic_gb:
-        text += f"Трафик: <i>{traffic_gb} ГБ</i>\n"
+        parts.append(f"Трафик: <i>{traffic_gb} ГБ</i>\n")
     
-    text += f"\n🔗 <b>VPN ссылка:</b>\n<code>{vless_link}</code>"
+    parts.append(f"\n🔗 <b>VPN ссылка:</b>\n<code>{vless_link}</code>")
+    text = "".join(parts)
     
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text="🗑️ Удалить", callback_data=f"delete_key:{key_id_db}"))
-    builder.row(InlineKeyboardButton(text="🔄 Заменить", callback_data=f"replace_key:{key_id_db}"))
-    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="manage_keys"))
-    
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=_key_actions_markup(key_id_db))
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("delete_key:"))
+@dp.callback_query(F.data.startswith(_PFX_DELETE_KEY))
 async def handle_delete_key(callback: CallbackQuery, state: FSMContext):
     """Удаление ключа"""
     user_id = callback.from_user.id
-    key_id = int(callback.data.split(":")[1])
+    key_id = int(callback.data[len(_PFX_DELETE_KEY):])
     
-    key_data = get_key_by_id(key_id, user_id)
+    key_data = await _run_db(get_key_by_id, key_id, user_id)
     if not key_data:
         await callback.answer("❌ Ключ не найден", show_alert=True)
         return
@@ -1673,28 +1804,27 @@ async def handle_delete_key(callback: CallbackQuery, state: FSMContext):
     key_id_db, key_name, vless_link, vless_client_id, created_at, expires_at, traffic_gb, is_active, server_id, server_name = key_data
     name = key_name or f"Ключ #{key_id_db}"
     
-    await state.update_data(key_to_delete=key_id_db, key_client_id=vless_client_id, key_server_id=server_id)
-    await state.set_state(KeyManagementStates.CONFIRMING_DELETE)
+    await asyncio.gather(
+        state.update_data(key_to_delete=key_id_db, key_client_id=vless_client_id, key_server_id=server_id),
+        state.set_state(KeyManagementStates.CONFIRMING_DELETE),
+    )
     
     await callback.message.edit_text(
         f"⚠️ <b>Подтверждение удаления</b>\n\n"
         f"Вы уверены, что хотите удалить ключ <b>{name}</b>?\n\n"
         f"Это действие нельзя отменить.",
         parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"confirm_delete:{key_id_db}")],
-            [InlineKeyboardButton(text="❌ Отмена", callback_data=f"view_key:{key_id_db}")]
-        ])
+        reply_markup=_delete_confirm_markup(key_id_db)
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("confirm_delete:"))
+@dp.callback_query(F.data.startswith(_PFX_CONFIRM_DELETE))
 async def handle_confirm_delete(callback: CallbackQuery, state: FSMContext):
     """Подтверждение удаления ключа"""
     user_id = callback.from_user.id
-    key_id = int(callback.data.split(":")[1])
+    key_id = int(callback.data[len(_PFX_CONFIRM_DELETE):])
     
-    key_data = get_key_by_id(key_id, user_id)
+    key_data = await _run_db(get_key_by_id, key_id, user_id)
     if not key_data:
         await callback.answer("❌ Ключ не найден", show_alert=True)
         await state.clear()
@@ -1703,48 +1833,28 @@ async def handle_confirm_delete(callback: CallbackQuery, state: FSMContext):
     key_id_db, key_name, vless_link, vless_client_id, created_at, expires_at, traffic_gb, is_active, server_id, server_name = key_data
     name = key_name or f"Ключ #{key_id_db}"
     
-    # Получаем данные сервера для удаления клиента
-    server_data = get_server_by_id(server_id)
-    if server_data:
-        server_id_db, server_name, server_ip, server_username, server_password, server_inbound_id, server_base_url = server_data
-        
-        # Удаляем клиент с сервера
-        try:
-            server_client = XUIClient(
-                base_url=server_base_url,
-                username=server_username,
-                password=server_password,
-                inbound_id=server_inbound_id
-            )
-            server_client.delete_client(vless_client_id)
-            logger.info(f"Successfully deleted client {vless_client_id} from server {server_id}")
-        except Exception as e:
-            logger.error(f"Failed to delete client from server: {e}")
-            # Продолжаем удаление из БД даже если не удалось удалить с сервера
-    
-    # Удаляем ключ из БД
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM vpn_keys WHERE id = ? AND user_id = ?', (key_id_db, user_id))
-        conn.commit()
+    # Удаляем клиент с сервера и ключ из БД параллельно: ошибка панели только логируется,
+    # и ключ из БД удаляется в любом случае
+    await asyncio.gather(
+        _delete_remote_client(server_id, vless_client_id),
+        _run_db(_delete_key_row, key_id_db, user_id)
+    )
     
     await callback.message.edit_text(
         f"✅ Ключ <b>{name}</b> успешно удален!",
         parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Назад к ключам", callback_data="manage_keys")]
-        ])
+        reply_markup=KEYS_BACK_MARKUP
     )
     await callback.answer()
     await state.clear()
 
-@dp.callback_query(F.data.startswith("replace_key:"))
+@dp.callback_query(F.data.startswith(_PFX_REPLACE_KEY))
 async def handle_replace_key(callback: CallbackQuery, state: FSMContext):
     """Замена ключа"""
     user_id = callback.from_user.id
-    key_id = int(callback.data.split(":")[1])
+    key_id = int(callback.data[len(_PFX_REPLACE_KEY):])
     
-    key_data = get_key_by_id(key_id, user_id)
+    key_data = await _run_db(get_key_by_id, key_id, user_id)
     if not key_data:
         await callback.answer("❌ Ключ не найден", show_alert=True)
         return
@@ -1755,16 +1865,16 @@ async def handle_replace_key(callback: CallbackQuery, state: FSMContext):
     await state.update_data(key_to_replace=key_id)
     
     # Показываем выбор сервера
-    active_servers = get_active_servers()
-    if not active_servers:
+    servers = await active_servers()
+    if not servers:
         await callback.answer("❌ Нет доступных серверов", show_alert=True)
         return
     
     builder = InlineKeyboardBuilder()
-    for server_id, server_name, server_ip, inbound_id in active_servers:
+    for server in servers:
         builder.row(InlineKeyboardButton(
-            text=f"🖥️ {server_name}",
-            callback_data=f"replace_key_server:{server_id}:{key_id}"
+            text=f"🖥️ {server.name}",
+            callback_data=f"replace_key_server:{server.id}:{key_id}"
         ))
     builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data=f"view_key:{key_id}"))
     
@@ -1776,21 +1886,28 @@ async def handle_replace_key(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("replace_key_server:"))
-async def handle_replace_key_server(callback: CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data.regexp(_REPLACE_KEY_SERVER_RE).as_("match"))
+async def handle_replace_key_server(callback: CallbackQuery, state: FSMContext, match: re.Match):
     """Обработка выбора сервера для замены ключа"""
-    parts = callback.data.split(":")
-    server_id = int(parts[1])
-    old_key_id = int(parts[2])
+    server_id = int(match[1])
+    old_key_id = int(match[2])
     
     await state.update_data(selected_server_id=server_id, key_to_replace=old_key_id)
     
-    # Сразу создаем ключ (используем ту же логику, что и при создании нового)
-    # Вызываем обработчик выбора сервера, который теперь создает ключ сразу
-    await handle_key_server_selection(callback, state)
+    # Сразу создаем ключ (используем ту же логику, что и при создании нового);
+    # callback_data здесь другого формата, поэтому server_id передаем явно
+    await _create_key(callback, state, server_id)
 
 # ==================== АДМИНСКИЕ КОМАНДЫ ДЛЯ УПРАВЛЕНИЯ СЕРВЕРАМИ ====================
 
+async def _advance(state: FSMContext, next_state, **data):
+    """Сохраняет данные шага и переключает состояние одновременно.
+
+    Состояние и данные FSM хранятся в хранилище раздельно, поэтому запись
+    идет параллельно, а не двумя последовательными обращениями.
+    """
+    await asyncio.gather(state.update_data(**data), state.set_state(next_state))
+
 @dp.message(Command("add_server"))
 async def cmd_add_server(message: Message, state: FSMContext):
     """Команда для добавления нового сервера"""
@@ -1808,7 +1925,7 @@ async def cmd_add_server(message: Message, state: FSMContext):
 @dp.message(AddServerSteps.WAITING_NAME)
 async def process_server_name(message: Message, state: FSMContext):
     """Обработка названия сервера"""
-    await state.update_data(name=message.text)
+    await _advance(state, AddServerSteps.WAITING_PANEL_URL, name=message.text)
     await message.answer(
         "🔗 Введите полную ссылку на панель 3x-ui:\n\n"
         "Примеры:\n"
@@ -1819,13 +1936,14 @@ async def process_server_name(message: Message, state: FSMContext):
         "адрес, порт и путь (если есть).",
         parse_mode="HTML"
     )
-    await state.set_state(AddServerSteps.WAITING_PANEL_URL)
+
+# Протокол, хост, необязательный порт и путь панели одним выражением вместо urlparse и split
+_PANEL_PROTOCOLS = frozenset({'http', 'https'})
+_PANEL_URL_RE = re.compile(r'^(?P<protocol>[a-z][a-z0-9+.-]*)://(?P<host>[^:/?#]+)(?::(?P<port>[^/?#]*))?(?P<path>/[^?#]*)', re.I)
 
 @dp.message(AddServerSteps.WAITING_PANEL_URL)
 async def process_server_panel_url(message: Message, state: FSMContext):
     """Обработка ссылки на панель"""
-    from urllib.parse import urlparse
-    
     panel_url = message.text.strip()
     
     # Убеждаемся, что URL заканчивается на /
@@ -1834,19 +1952,18 @@ async def process_server_panel_url(message: Message, state: FSMContext):
     
     # Парсим URL
     try:
-        parsed = urlparse(panel_url)
-        if not parsed.scheme or not parsed.netloc:
+        match = _PANEL_URL_RE.match(panel_url)
+        if not match:
             raise ValueError("Неверный формат URL")
         
-        protocol = parsed.scheme.lower()
-        if protocol not in ['http', 'https']:
+        protocol = match['protocol'].lower()
+        if protocol not in _PANEL_PROTOCOLS:
             await message.answer("❌ Поддерживаются только протоколы HTTP и HTTPS. Попробуйте снова:")
             return
 
         # Извлекаем IP/домен и порт
-        netloc = parsed.netloc
-        if ':' in netloc:
-            host, port_str = netloc.rsplit(':', 1)
+        host, port_str, path = match['host'], match['port'], match['path']
+        if port_str is not None:
             try:
                 port = int(port_str)
             except ValueError:
@@ -1854,12 +1971,8 @@ async def process_server_panel_url(message: Message, state: FSMContext):
                 return
         else:
             # Если порт не указан, используем стандартный
-            host = netloc
             port = 443 if protocol == 'https' else 80
         
-        # Путь из URL
-        path = parsed.path
-        
         # Формируем base_url (убираем путь из base_url, так как он будет использоваться в запросах)
         # Но сохраняем полный URL для отображения
         base_url = f"{protocol}://{host}:{port}{path}".rstrip('/')
@@ -1867,7 +1980,9 @@ async def process_server_panel_url(message: Message, state: FSMContext):
         # Извлекаем IP или домен
         ip_or_domain = host
         
-        await state.update_data(
+        await _advance(
+            state,
+            AddServerSteps.WAITING_USERNAME,
             ip=ip_or_domain,
             port=port,
             protocol=protocol,
@@ -1886,7 +2001,6 @@ async def process_server_panel_url(message: Message, state: FSMContext):
             f"Введите username для панели 3x-ui:",
             parse_mode="HTML"
         )
-        await state.set_state(AddServerSteps.WAITING_USERNAME)
         
     except Exception as e:
         await message.answer(
@@ -1900,16 +2014,14 @@ async def process_server_panel_url(message: Message, state: FSMContext):
 @dp.message(AddServerSteps.WAITING_USERNAME)
 async def process_server_username(message: Message, state: FSMContext):
     """Обработка username"""
-    await state.update_data(username=message.text)
+    await _advance(state, AddServerSteps.WAITING_PASSWORD, username=message.text)
     await message.answer("Введите password для панели 3x-ui:")
-    await state.set_state(AddServerSteps.WAITING_PASSWORD)
 
 @dp.message(AddServerSteps.WAITING_PASSWORD)
 async def process_server_password(message: Message, state: FSMContext):
     """Обработка password"""
-    await state.update_data(password=message.text)
+    await _advance(state, AddServerSteps.WAITING_INBOUND_ID, password=message.text)
     await message.answer("Введите Inbound ID (число):")
-    await state.set_state(AddServerSteps.WAITING_INBOUND_ID)
 
 @dp.message(AddServerSteps.WAITING_INBOUND_ID)
 async def process_server_inbound_id(message: Message, state: FSMContext):
@@ -1937,7 +2049,10 @@ async def process_server_inbound_id(message: Message, state: FSMContext):
             password=password,
             inbound_id=inbound_id
         )
-        test_client.login()
+        try:
+            await _xui_call(test_client.login)
+        finally:
+            await test_client.aclose()
         await message.answer(
             f"✅ <b>Подключение к серверу успешно!</b>\n\n"
             f"<b>Данные сервера:</b>\n"
@@ -1951,8 +2066,7 @@ async def process_server_inbound_id(message: Message, state: FSMContext):
             f"Сохранить этот сервер? (да/нет)",
             parse_mode="HTML"
         )
-        await state.update_data(inbound_id=inbound_id)
-        await state.set_state(AddServerSteps.CONFIRMING)
+        await _advance(state, AddServerSteps.CONFIRMING, inbound_id=inbound_id)
     except Exception as e:
         error_msg = str(e)
         # Предлагаем попробовать другой протокол при SSL ошибке
@@ -1966,10 +2080,63 @@ async def process_server_inbound_id(message: Message, state: FSMContext):
         )
         await state.clear()
 
+def _insert_server(name: str, ip: str, port: int, protocol: str, username: str,
+                   password: str, inbound_id: int, base_url: str) -> int:
+    """Сохраняет новый сервер и возвращает его ID"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO servers (name, ip, port, protocol, username, password, inbound_id, base_url, is_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, TRUE)
+        ''', (name, ip, port, protocol, username, password, inbound_id, base_url))
+        return cursor.lastrowid
+
+def _fetch_all_servers():
+    """Все серверы (включая неактивные) для админского списка"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, name, ip, is_active 
+            FROM servers 
+            ORDER BY id
+        ''')
+        return cursor.fetchall()
+
+def _toggle_server(server_id: int) -> bool | None:
+    """Переключает активность сервера; возвращает новый статус или None, если сервера нет"""
+    with get_connection(_DB_PATH) as conn:
+        # Переключаем статус одним запросом; RETURNING сразу отдает новое значение
+        result = conn.execute('''
+            UPDATE servers 
+            SET is_active = NOT is_active, updated_at = datetime('now')
+            WHERE id = ?
+            RETURNING is_active
+        ''', (server_id,)).fetchone()
+    return bool(result[0]) if result else None
+
+def _delete_server(server_id: int) -> tuple[int, bool]:
+    """Удаляет неиспользуемый сервер; возвращает число его пользователей и признак удаления"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        # Удаляем только неиспользуемый сервер одним запросом
+        cursor.execute('''
+            DELETE FROM servers
+            WHERE id = ? AND NOT EXISTS (SELECT 1 FROM users WHERE server_id = ?)
+            RETURNING id
+        ''', (server_id, server_id))
+        if cursor.fetchone():
+            return 0, True
+        # Сервер не удален: считаем пользователей только для сообщения об ошибке
+        cursor.execute('SELECT COUNT(*) FROM users WHERE server_id = ?', (server_id,))
+        return cursor.fetchone()[0], False
+
+# Ответы, подтверждающие добавление сервера
+_CONFIRM_ANSWERS = frozenset({'да', 'yes', 'y', 'д'})
+
 @dp.message(AddServerSteps.CONFIRMING)
 async def process_server_confirmation(message: Message, state: FSMContext):
     """Обработка подтверждения добавления сервера"""
-    if message.text.lower() not in ['да', 'yes', 'y', 'д']:
+    if (message.text or '').strip().casefold() not in _CONFIRM_ANSWERS:
         await message.answer("❌ Добавление сервера отменено.")
         await state.clear()
         return
@@ -1985,14 +2152,8 @@ async def process_server_confirmation(message: Message, state: FSMContext):
     inbound_id = data.get('inbound_id')
     
     # Сохраняем сервер в БД
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO servers (name, ip, port, protocol, username, password, inbound_id, base_url, is_active)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, TRUE)
-        ''', (name, ip, port, protocol, username, password, inbound_id, base_url))
-        conn.commit()
-        server_id = cursor.lastrowid
+    server_id = await _run_db(_insert_server, name, ip, port, protocol, username, password, inbound_id, base_url)
+    invalidate_servers_cache()
     
     await message.answer(
         f"✅ <b>Сервер успешно добавлен!</b>\n\n"
@@ -2010,30 +2171,18 @@ async def cmd_list_servers(message: Message):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
     
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, ip, is_active 
-            FROM servers 
-            ORDER BY id
-        ''')
-        servers = cursor.fetchall()
+    servers = await _run_db(_fetch_all_servers)
     
     if not servers:
         await message.answer("📭 Серверы не найдены. Используйте /add_server для добавления.")
         return
     
-    text = "🖥️ <b>Список серверов:</b>\n\n"
-    for server_id, name, ip, is_active in servers:
-        status = "✅ Активен" if is_active else "❌ Неактивен"
-        text += f"{server_id}. <b>{name}</b> ({ip})\n   {status}\n\n"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Добавить сервер", callback_data="admin_add_server")],
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_refresh_servers")]
-    ])
+    text = "🖥️ <b>Список серверов:</b>\n\n" + "".join(
+        f"{server_id}. <b>{name}</b> ({ip})\n   {'✅ Активен' if is_active else '❌ Неактивен'}\n\n"
+        for server_id, name, ip, is_active in servers
+    )
     
-    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+    await message.answer(text, parse_mode="HTML", reply_markup=ADMIN_SERVERS_MARKUP)
 
 @dp.message(Command("toggle_server"))
 async def cmd_toggle_server(message: Message):
@@ -2053,28 +2202,14 @@ async def cmd_toggle_server(message: Message):
         await message.answer("❌ Server ID должен быть числом.")
         return
     
-    with get_connection(cfg.database.db_path) as conn:
-        cursor = conn.cursor()
-        # Получаем текущий статус
-        cursor.execute('SELECT is_active FROM servers WHERE id = ?', (server_id,))
-        result = cursor.fetchone()
-        
-        if not result:
-            await message.answer(f"❌ Сервер с ID {server_id} не найден.")
-            return
-        
-        current_status = result[0]
-        new_status = not current_status
-        
-        cursor.execute('''
-            UPDATE servers 
-            SET is_active = ?, updated_at = datetime('now')
-            WHERE id = ?
-        ''', (new_status, server_id))
-        conn.commit()
-        
-        status_text = "активирован" if new_status else "деактивирован"
-        await message.answer(f"✅ Сервер {server_id} {status_text}.")
+    new_status = await _run_db(_toggle_server, server_id)
+    if new_status is None:
+        await message.answer(f"❌ Сервер с ID {server_id} не найден.")
+        return
+    invalidate_servers_cache()
+    
+    status_text = "активирован" if new_status else "деактивирован"
+    await message.answer(f"✅ Сервер {server_id} {status_text}.")
 
 @dp.message(Command("delete_server"))
 async def cmd_delete_server(message: Message):
@@ -2094,140 +2229,164 @@ async def cmd_delete_server(message: Message):
         await message.answer("❌ Server ID должен быть числом.")
         return
     
-    with get_connection(cfg.database.db_path) as conn:
+    users_count, deleted = await _run_db(_delete_server, server_id)
+    if users_count > 0:
+        await message.answer(
+            f"❌ Нельзя удалить сервер, который используется {users_count} пользователями.\n"
+            f"Сначала деактивируйте сервер: /toggle_server {server_id}"
+        )
+        return
+    invalidate_servers_cache()
+    # Клиент панели удаленного сервера больше не понадобится
+    cached = _XUI_CLIENTS.pop(server_id, None)
+    if cached is not None:
+        await cached[1].aclose()
+    
+    if deleted:
+        await message.answer(f"✅ Сервер {server_id} удален.")
+    else:
+        await message.answer(f"❌ Сервер с ID {server_id} не найден.")
+
+def _load_sync_targets(db_path: str):
+    """Активные подписки с их ключами: [(user_id, subscription_end, keys), ...]"""
+    with get_connection(db_path) as conn:
         cursor = conn.cursor()
-        # Проверяем, используется ли сервер
-        cursor.execute('SELECT COUNT(*) FROM users WHERE server_id = ?', (server_id,))
-        users_count = cursor.fetchone()[0]
         
-        if users_count > 0:
-            await message.answer(
-                f"❌ Нельзя удалить сервер, который используется {users_count} пользователями.\n"
-                f"Сначала деактивируйте сервер: /toggle_server {server_id}"
-            )
-            return
+        # Получаем всех пользователей с активными подписками
+        cursor.execute('''
+            SELECT user_id, subscription_end
+            FROM users
+            WHERE pay_subscribed = 1 
+              AND subscription_end IS NOT NULL
+              AND subscription_end >= DATE('now', 'localtime')
+        ''')
+        users = cursor.fetchall()
         
-        cursor.execute('DELETE FROM servers WHERE id = ?', (server_id,))
+        targets = []
+        for user_id, subscription_end in users:
+            # Получаем все активные ключи пользователя
+            cursor.execute('''
+                SELECT k.id, k.server_id, k.vless_client_id, k.expires_at, s.name, s.ip, 
+                       s.username, s.password, s.inbound_id, s.base_url
+                FROM vpn_keys k
+                LEFT JOIN servers s ON k.server_id = s.id
+                WHERE k.user_id = ? AND k.is_active = TRUE
+            ''', (user_id,))
+            targets.append((user_id, subscription_end, cursor.fetchall()))
+        return targets
+
+def _save_key_expiries(db_path: str, key_updates: list[tuple[str, int]]):
+    """Записывает новые даты истечения ключей одной транзакцией"""
+    with get_connection(db_path) as conn:
+        conn.executemany('UPDATE vpn_keys SET expires_at = ? WHERE id = ?', key_updates)
         conn.commit()
-        
-        if cursor.rowcount > 0:
-            await message.answer(f"✅ Сервер {server_id} удален.")
-        else:
-            await message.answer(f"❌ Сервер с ID {server_id} не найден.")
 
 async def sync_subscriptions_and_keys(db_path: str):
     """Синхронизирует подписки и ключи: продлевает ключи до даты окончания подписки"""
     logger.info("Starting subscription and keys synchronization...")
     
     try:
-        with get_connection(db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Получаем всех пользователей с активными подписками
-            cursor.execute('''
-                SELECT user_id, subscription_end, pay_subscribed
-                FROM users
-                WHERE pay_subscribed = 1 
-                  AND subscription_end IS NOT NULL
-                  AND subscription_end >= DATE('now')
-            ''')
-            users = cursor.fetchall()
-            
-            updated_count = 0
-            error_count = 0
-            
-            for user_id, subscription_end, pay_subscribed in users:
-                try:
-                    # Парсим дату окончания подписки
-                    if isinstance(subscription_end, str):
-                        if ' ' in subscription_end:
-                            sub_end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
-                        else:
-                            sub_end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
+        # Пользователи и их ключи одним вызовом в пуле БД; к панелям обращаемся вне соединения
+        users = await _run_db(_load_sync_targets, db_path)
+        
+        updated_count = 0
+        error_count = 0
+        # Новые даты ключей пишем в БД одним executemany и одним commit после обхода
+        key_updates = []
+
+        for user_id, subscription_end, keys in users:
+            try:
+                # Парсим дату окончания подписки
+                if isinstance(subscription_end, str):
+                    if ' ' in subscription_end:
+                        sub_end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
                     else:
-                        sub_end_date = subscription_end
-                    
-                    # Вычисляем expiry_time в миллисекундах (конец дня)
-                    from datetime import time as dt_time
-                    sub_end_datetime = datetime.combine(sub_end_date.date(), dt_time(23, 59, 59))
-                    subscription_expiry_ms = int(sub_end_datetime.timestamp() * 1000)
-                    
-                    # Получаем все активные ключи пользователя
-                    cursor.execute('''
-                        SELECT k.id, k.server_id, k.vless_client_id, k.expires_at, s.name, s.base_url, 
-                               s.username, s.password, s.inbound_id
-                        FROM vpn_keys k
-                        LEFT JOIN servers s ON k.server_id = s.id
-                        WHERE k.user_id = ? AND k.is_active = TRUE
-                    ''', (user_id,))
-                    keys = cursor.fetchall()
-                    
-                    for key_data in keys:
-                        key_id, server_id, vless_client_id, key_expires_at, server_name, \
-                        server_base_url, server_username, server_password, server_inbound_id = key_data
-                        
-                        if not server_id or not vless_client_id:
-                            continue
-                        
-                        # Парсим дату истечения ключа
-                        try:
-                            if isinstance(key_expires_at, str):
-                                if ' ' in key_expires_at:
-                                    key_end_date = datetime.strptime(key_expires_at.split()[0], "%Y-%m-%d")
-                                else:
-                                    key_end_date = datetime.strptime(key_expires_at, "%Y-%m-%d")
+                        sub_end_date = datetime.strptime(subscription_end, "%Y-%m-%d")
+                else:
+                    sub_end_date = subscription_end
+
+                # Вычисляем expiry_time в миллисекундах (конец дня)
+                from datetime import time as dt_time
+                sub_end_datetime = datetime.combine(sub_end_date.date(), dt_time(23, 59, 59))
+                subscription_expiry_ms = int(sub_end_datetime.timestamp() * 1000)
+
+                for key_data in keys:
+                    key_id, server_id, vless_client_id, key_expires_at = key_data[:4]
+
+                    if not server_id or not vless_client_id:
+                        continue
+
+                    # Парсим дату истечения ключа
+                    try:
+                        if isinstance(key_expires_at, str):
+                            if ' ' in key_expires_at:
+                                key_end_date = datetime.strptime(key_expires_at.split()[0], "%Y-%m-%d")
                             else:
-                                key_end_date = key_expires_at
-                            
-                            # Вычисляем expiry_time ключа в миллисекундах
-                            key_end_datetime = datetime.combine(key_end_date.date(), dt_time(23, 59, 59))
-                            key_expiry_ms = int(key_end_datetime.timestamp() * 1000)
-                            
-                            # Если подписка продлена (дата окончания подписки > дата истечения ключа)
-                            if subscription_expiry_ms > key_expiry_ms:
-                                # Обновляем ключ в панели x-ui
-                                try:
-                                    server_client = XUIClient(
-                                        base_url=server_base_url,
-                                        username=server_username,
-                                        password=server_password,
-                                        inbound_id=server_inbound_id
-                                    )
-                                    
-                                    server_client.update_client_expiry(
-                                        client_id=vless_client_id,
-                                        expiry_time_unix_ms=subscription_expiry_ms
-                                    )
-                                    
-                                    # Обновляем дату истечения ключа в БД
-                                    new_expires_at = sub_end_date.strftime("%Y-%m-%d")
-                                    cursor.execute('''
-                                        UPDATE vpn_keys
-                                        SET expires_at = ?
-                                        WHERE id = ?
-                                    ''', (new_expires_at, key_id))
-                                    conn.commit()
-                                    
-                                    updated_count += 1
-                                    logger.info(f"Updated key {key_id} (client {vless_client_id}) for user {user_id} "
-                                              f"from {key_expires_at} to {subscription_end}")
-                                    
-                                except Exception as e:
-                                    error_count += 1
-                                    logger.error(f"Failed to update key {key_id} for user {user_id}: {e}")
-                            
-                        except Exception as e:
-                            logger.error(f"Error parsing key expiry date for key {key_id}: {e}")
-                            error_count += 1
-                
-                except Exception as e:
-                    logger.error(f"Error processing user {user_id}: {e}")
-                    error_count += 1
-            
-            logger.info(f"Subscription and keys sync completed: {updated_count} keys updated, {error_count} errors")
+                                key_end_date = datetime.strptime(key_expires_at, "%Y-%m-%d")
+                        else:
+                            key_end_date = key_expires_at
+
+                        # Вычисляем expiry_time ключа в миллисекундах
+                        key_end_datetime = datetime.combine(key_end_date.date(), dt_time(23, 59, 59))
+                        key_expiry_ms = int(key_end_datetime.timestamp() * 1000)
+
+                        # Если подписка продлена (дата окончания подписки > дата истечения ключа)
+                        if subscription_expiry_ms > key_expiry_ms:
+                            # Обновляем ключ в панели x-ui
+                            try:
+                                server_client = get_xui_client(Server(server_id, *key_data[4:]))
+
+                                await server_client.update_client_expiry(
+                                    client_id=vless_client_id,
+                                    expiry_time_unix_ms=subscription_expiry_ms
+                                )
+
+                                # Дату истечения ключа в БД обновим после обхода
+                                key_updates.append((sub_end_date.strftime("%Y-%m-%d"), key_id))
+
+                                updated_count += 1
+                                logger.info("Updated key %s (client %s) for user %s from %s to %s",
+                                            key_id, vless_client_id, user_id, key_expires_at, subscription_end)
+
+                            except Exception as e:
+                                error_count += 1
+                                logger.error("Failed to update key %s for user %s: %s", key_id, user_id, e)
+
+                    except Exception as e:
+                        logger.error("Error parsing key expiry date for key %s: %s", key_id, e)
+                        error_count += 1
+
+            except Exception as e:
+                logger.error("Error processing user %s: %s", user_id, e)
+                error_count += 1
+
+        if key_updates:
+            await _run_db(_save_key_expiries, db_path, key_updates)
+        
+        logger.info("Subscription and keys sync completed: %s keys updated, %s errors", updated_count, error_count)
     
     except Exception as e:
-        logger.error(f"Error in sync_subscriptions_and_keys: {e}")
+        logger.error("Error in sync_subscriptions_and_keys: %s", e)
+
+class _SendRateLimiter:
+    """Равномерно распределяет рассылку во времени, чтобы не упираться в лимит Bot API (~30 сообщений/с)"""
+
+    def __init__(self, rate: int, period: float = 1.0):
+        self._interval = period / rate
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        # Слот резервируется без await, поэтому отдельная блокировка в event loop не нужна
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+_SEND_LIMITER = _SendRateLimiter(28)
 
 async def send_feedback_request(db_path: str):
     """Отправляет опрос о качестве VPN через 3 дня после покупки подписки"""
@@ -2255,7 +2414,7 @@ async def send_feedback_request(db_path: str):
                 JOIN users u ON p.user_id = u.user_id
                 WHERE p.status = 'completed'
                   AND p.plan_type = 'subscription'
-                  AND DATE(p.timestamp) = DATE('now', '-3 days')
+                  AND DATE(p.timestamp, 'localtime') = DATE('now', 'localtime', '-3 days')
                   AND p.id NOT IN (
                       SELECT payment_id FROM feedback_ratings 
                       WHERE payment_id IS NOT NULL
@@ -2263,40 +2422,44 @@ async def send_feedback_request(db_path: str):
             ''')
             users_to_notify = cursor.fetchall()
             
+            # Отбираем получателей и их платежи до рассылки, чтобы не держать соединение во время отправки
+            requests_to_send = []
             for user_id, username, first_name in users_to_notify:
-                try:
-                    # Проверяем, что у пользователя все еще активная подписка
-                    cursor.execute('''
-                        SELECT pay_subscribed, subscription_end
-                        FROM users
-                        WHERE user_id = ? AND pay_subscribed = 1
-                          AND subscription_end >= DATE('now')
-                    ''', (user_id,))
-                    sub_check = cursor.fetchone()
-                    
-                    if not sub_check:
-                        continue
-                    
-                    # Получаем ID последнего платежа для связи с рейтингом
-                    cursor.execute('''
-                        SELECT id FROM payments
-                        WHERE user_id = ? AND status = 'completed'
-                          AND DATE(timestamp) = DATE('now', '-3 days')
-                        ORDER BY id DESC LIMIT 1
-                    ''', (user_id,))
-                    payment_result = cursor.fetchone()
-                    payment_id = payment_result[0] if payment_result else None
-                    
-                    # Отправляем опрос - кнопки в строку с цифрами 1-5 и звездами
-                    builder = InlineKeyboardBuilder()
-                    buttons = []
-                    for rating in range(1, 6):
-                        buttons.append(InlineKeyboardButton(
-                            text=f"{rating} ⭐️",
-                            callback_data=f"feedback_rating:{rating}:{payment_id or 0}"
-                        ))
-                    builder.row(*buttons)
-                    
+                # Проверяем, что у пользователя все еще активная подписка
+                cursor.execute('''
+                    SELECT pay_subscribed, subscription_end
+                    FROM users
+                    WHERE user_id = ? AND pay_subscribed = 1
+                      AND subscription_end >= DATE('now', 'localtime')
+                ''', (user_id,))
+                sub_check = cursor.fetchone()
+                
+                if not sub_check:
+                    continue
+                
+                # Получаем ID последнего платежа для связи с рейтингом
+                cursor.execute('''
+                    SELECT id FROM payments
+                    WHERE user_id = ? AND status = 'completed'
+                      AND DATE(timestamp, 'localtime') = DATE('now', 'localtime', '-3 days')
+                    ORDER BY id DESC LIMIT 1
+                ''', (user_id,))
+                payment_result = cursor.fetchone()
+                requests_to_send.append((user_id, payment_result[0] if payment_result else None))
+        
+        async def request_feedback(user_id: int, payment_id):
+            try:
+                # Отправляем опрос - кнопки в строку с цифрами 1-5 и звездами
+                builder = InlineKeyboardBuilder()
+                buttons = []
+                for rating in range(1, 6):
+                    buttons.append(InlineKeyboardButton(
+                        text=f"{rating} ⭐️",
+                        callback_data=f"feedback_rating:{rating}:{payment_id or 0}"
+                    ))
+                builder.row(*buttons)
+                
+                async with _SEND_LIMITER:
                     await bot.send_message(
                         chat_id=user_id,
                         text=(
@@ -2306,16 +2469,20 @@ async def send_feedback_request(db_path: str):
                         reply_markup=builder.as_markup(),
                         parse_mode="HTML"
                     )
-                    
-                    logger.info(f"Sent feedback request to user {user_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Failed to send feedback request to user {user_id}: {e}")
-            
-            logger.info(f"Feedback requests completed: {len(users_to_notify)} users notified")
+                
+                logger.info("Sent feedback request to user %s", user_id)
+                
+            except Exception as e:
+                logger.error("Failed to send feedback request to user %s: %s", user_id, e)
+        
+        await asyncio.gather(*(
+            request_feedback(user_id, payment_id)
+            for user_id, payment_id in requests_to_send
+        ))
+        logger.info("Feedback requests completed: %s users notified", len(requests_to_send))
     
     except Exception as e:
-        logger.error(f"Error in send_feedback_request: {e}")
+        logger.error("Error in send_feedback_request: %s", e)
 
 async def send_subscription_reminder(db_path: str):
     """Отправляет напоминание о скидке за 3 дня до окончания подписки"""
@@ -2331,89 +2498,96 @@ async def send_subscription_reminder(db_path: str):
                 FROM users
                 WHERE pay_subscribed = 1
                   AND subscription_end IS NOT NULL
-                  AND DATE(subscription_end) = DATE('now', '+3 days')
+                  AND DATE(subscription_end) = DATE('now', 'localtime', '+3 days')
             ''')
             users_to_remind = cursor.fetchall()
-            
-            for user_id, username, first_name, subscription_end in users_to_remind:
+        
+        async def remind(user_id: int, subscription_end):
+            try:
                 try:
-                    # Форматируем дату окончания
-                    try:
-                        if isinstance(subscription_end, str):
-                            end_date = datetime.strptime(subscription_end.split()[0], "%Y-%m-%d")
-                        else:
-                            end_date = subscription_end
-                        end_date_str = end_date.strftime("%d.%m.%Y")
-                        # Вычисляем количество дней до окончания
-                        days_remaining = (end_date - datetime.now()).days
-                        days_display = "&lt;1" if days_remaining < 1 else str(days_remaining)
-                    except:
-                        end_date_str = subscription_end
-                        days_display = "?"
-                    
-                    # Формируем кнопки для продления подписки (как в меню премиум при остатке <= 3 дней)
-                    builder = InlineKeyboardBuilder()
-                    for plan_id, plan_data in RENEWAL_PLANS.items():
-                        builder.button(
-                            text=f"{plan_data['title']} - {plan_data['price_rub'] // 100}₽ | {plan_data['price_stars']}⭐",
-                            callback_data=f"plan:{plan_id}"
-                        )
-                    builder.adjust(1)
-                    builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="go_back"))
-                    
+                    _, text = _reminder_text(_parse_date(subscription_end))
+                except (TypeError, ValueError):
+                    text = REMINDER_TEMPLATE.format_map({'days': "?", 'end_date': subscription_end})
+                
+                async with _SEND_LIMITER:
                     await bot.send_message(
                         chat_id=user_id,
-                        text=(
-                            "⏰ <b>Напоминание о подписке</b>\n\n"
-                            f"Ваша VPN подписка истекает <b>через {days_display} дней</b> ({end_date_str})\n\n"
-                            "🔥 <b>Сейчас действует скидка!</b>\n"
-                            "Успей продлить подписку сейчас и получи выгодную цену.\n\n"
-                            "Не упусти возможность продолжить пользоваться VPN по специальной цене! 🎁"
-                        ),
-                        reply_markup=builder.as_markup(),
+                        text=text,
+                        reply_markup=RENEWAL_MARKUP,
                         parse_mode="HTML"
                     )
-                    
-                    logger.info(f"Sent subscription reminder to user {user_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Failed to send reminder to user {user_id}: {e}")
-            
-            logger.info(f"Subscription reminders completed: {len(users_to_remind)} users notified")
+                
+                logger.info("Sent subscription reminder to user %s", user_id)
+                
+            except Exception as e:
+                logger.error("Failed to send reminder to user %s: %s", user_id, e)
+        
+        await asyncio.gather(*(
+            remind(user_id, subscription_end)
+            for user_id, username, first_name, subscription_end in users_to_remind
+        ))
+        logger.info("Subscription reminders completed: %s users notified", len(users_to_remind))
     
     except Exception as e:
-        logger.error(f"Error in send_subscription_reminder: {e}")
+        logger.error("Error in send_subscription_reminder: %s", e)
+
+async def expire_subscriptions(db_path: str):
+    """Отключает просроченные подписки и уведомляет пользователей"""
+    async def notify(user_id: int):
+        try:
+            # Темп отправки задает общий лимитер, а не последовательные await
+            async with _SEND_LIMITER:
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=(
+                        "⌛ <b>Ваша VPN подписка закончилась</b>\n\n"
+                        "Оформите новую подписку, чтобы продолжить пользоваться VPN."
+                    ),
+                    reply_markup=PLANS_MARKUP,
+                    parse_mode="HTML"
+                )
+        except Exception as e:
+            logger.error("Failed to send expiration notice to user %s: %s", user_id, e)
+
+    try:
+        expired_ids = await _run_db(check_expired_subscriptions, db_path)
+        await asyncio.gather(*(notify(user_id) for user_id in expired_ids))
+    except Exception as e:
+        logger.error("Error in expire_subscriptions: %s", e)
+
+def _save_feedback_rating(user_id: int, payment_id: int | None, rating: int):
+    """Сохраняет оценку пользователя"""
+    with get_connection(_DB_PATH) as conn:
+        cursor = conn.cursor()
+        
+        # Проверяем, существует ли таблица feedback_ratings
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS feedback_ratings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                payment_id INTEGER,
+                rating INTEGER,
+                timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Сохраняем рейтинг
+        cursor.execute('''
+            INSERT INTO feedback_ratings (user_id, payment_id, rating)
+            VALUES (?, ?, ?)
+        ''', (user_id, payment_id, rating))
+        conn.commit()
 
-@dp.callback_query(F.data.startswith("feedback_rating:"))
-async def handle_feedback_rating(callback: CallbackQuery):
+@dp.callback_query(F.data.regexp(_FEEDBACK_RATING_RE).as_("match"))
+async def handle_feedback_rating(callback: CallbackQuery, match: re.Match):
     """Обработчик рейтинга от пользователя"""
     user_id = callback.from_user.id
-    parts = callback.data.split(":")
-    rating = int(parts[1])
-    payment_id = int(parts[2]) if len(parts) > 2 else 0
+    rating = int(match[1])
+    payment_id = int(match[2] or 0)
     
     try:
         # Сохраняем рейтинг в БД
-        with get_connection(cfg.database.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Проверяем, существует ли таблица feedback_ratings
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS feedback_ratings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    payment_id INTEGER,
-                    rating INTEGER,
-                    timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Сохраняем рейтинг
-            cursor.execute('''
-                INSERT INTO feedback_ratings (user_id, payment_id, rating)
-                VALUES (?, ?, ?)
-            ''', (user_id, payment_id if payment_id > 0 else None, rating))
-            conn.commit()
+        await _run_db(_save_feedback_rating, user_id, payment_id if payment_id > 0 else None, rating)
         
         # Отправляем благодарность
         await callback.message.edit_text(
@@ -2441,20 +2615,27 @@ async def handle_feedback_rating(callback: CallbackQuery):
                     parse_mode="HTML"
                 )
             except Exception as e:
-                logger.error(f"Failed to send feedback to admin {admin_id}: {e}")
+                logger.error("Failed to send feedback to admin %s: %s", admin_id, e)
         
     except Exception as e:
-        logger.error(f"Error handling feedback rating: {e}")
+        logger.error("Error handling feedback rating: %s", e)
         await callback.answer("❌ Ошибка при сохранении отзыва", show_alert=True)
 
 async def daily_scheduler():
-    scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
+    # Если event loop был занят в момент запуска, задача выполнится с опозданием до часа,
+    # а не будет пропущена; накопившиеся пропуски схлопываются в один запуск
+    scheduler = AsyncIOScheduler(
+        timezone="Europe/Moscow",
+        job_defaults={"misfire_grace_time": 3600, "coalesce": True}
+    )
+    # Обновление кэшированной текущей даты в начале каждого часа
+    scheduler.add_job(_refresh_today, 'cron', minute=0)
     scheduler.add_job(
-        check_expired_subscriptions,
+        expire_subscriptions,
         'cron',
         hour=11,
         minute=51,
-        args=[cfg.database.db_path]
+        args=[_DB_PATH]
     )
     # Синхронизация подписок и ключей раз в день в 12:05
     scheduler.add_job(
@@ -2462,7 +2643,7 @@ async def daily_scheduler():
         'cron',
         hour=11,
         minute=53,
-        args=[cfg.database.db_path]
+        args=[_DB_PATH]
     )
     # Отправка опросов через 3 дня после покупки в 12:10
     scheduler.add_job(
@@ -2470,7 +2651,7 @@ async def daily_scheduler():
         'cron',
         hour=12,
         minute=10,
-        args=[cfg.database.db_path]
+        args=[_DB_PATH]
     )
     # Напоминания о подписке за 3 дня до окончания в 12:15
     scheduler.add_job(
@@ -2478,7 +2659,7 @@ async def daily_scheduler():
         'cron',
         hour=12,
         minute=15,
-        args=[cfg.database.db_path]
+        args=[_DB_PATH]
     )
     scheduler.start()
 
@@ -2488,11 +2669,19 @@ async def main():
         await dp.start_polling(bot)
     finally:
         await bot.session.close()
+        await asyncio.gather(
+            xui_client.aclose(),
+            *(client.aclose() for _, client in _XUI_CLIENTS.values()),
+            return_exceptions=True,
+        )
 
 if __name__ == "__main__":
     print("Бот запущен!")
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         pass
     print("\nБот остановлен!")
@@ -1,38 +1,75 @@
 from __future__ import annotations
 
+import asyncio
+import itertools
 import json
+import logging
+import ssl
 import time
 import uuid
-from dataclasses import dataclass
 from typing import Any
 
 import httpx
 
+try:
+    # orjson в разы быстрее json на больших ответах inbounds/list; без него работаем на стандартном json
+    import orjson
+except ImportError:
+    orjson = None
+
 from .config import XUIConfig
 
+logger = logging.getLogger(__name__)
 
-@dataclass
-class VlessClient:
-    id: str
-    email: str
-    flow: str | None = None
-    limit_ip: int | None = None
-    total_gb: int | None = None  # in GB
-    expiry_time_unix_ms: int | None = None
+# Тела запросов к API панели уже закодированы в JSON. Заголовок не задается на уровне
+# клиента, потому что вход отправляет форму и получает свой Content-Type от httpx
+JSON_HEADERS = {"Content-Type": "application/json"}
 
-    def to_3xui_json(self) -> dict[str, Any]:
-        payload: dict[str, Any] = {
-            "id": self.id,
-            "email": self.email,
-            "enable": True,
-            "flow": self.flow or "",
-            "limitIp": self.limit_ip or 0,
-            "totalGB": (self.total_gb or 0) * 1073741824,  # bytes
-            "expiryTime": self.expiry_time_unix_ms or 0,
-            "subId": "",
-            "reset": 0,
-        }
-        return payload
+# Панели обычно работают на самоподписанных сертификатах по IP, поэтому сертификат
+# не проверяется. Контекст общий для всех клиентов: httpx при verify=False собирал бы
+# новый на каждый XUIClient
+PANEL_SSL_CONTEXT = ssl.create_default_context()
+PANEL_SSL_CONTEXT.check_hostname = False
+PANEL_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# Поля inbound, которые отправляются при его обновлении; статистика
+# (up, down, total, allTime, clientStats) не отправляется
+INBOUND_UPDATE_FIELDS = ('id', 'settings', 'streamSettings', 'sniffing', 'protocol',
+                         'port', 'listen', 'remark', 'enable', 'expiryTime',
+                         'trafficReset', 'lastTrafficResetTime', 'tag')
+
+# Сколько секунд считаем описание inbound (порт, streamSettings) актуальным
+INBOUND_CACHE_TTL = 60
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumpb(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+else:
+    _loads = json.loads
+
+    def _dumpb(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+
+def _dumps(obj: Any) -> str:
+    """JSON строкой: панель ожидает settings как строку внутри тела запроса"""
+    return _dumpb(obj).decode()
+
+
+def _first(value: Any) -> str:
+    """Первое значение из списка, строки JSON со списком или просто строки"""
+    if isinstance(value, str):
+        if not value.startswith('['):
+            return value
+        try:
+            value = _loads(value)
+        except ValueError:
+            return value
+    if isinstance(value, list) and value:
+        return value[0]
+    return ''
 
 
 class XUIClient:
@@ -40,46 +77,53 @@ class XUIClient:
                  password: str = None, api_token: str = None, inbound_id: int = None) -> None:
         """Инициализация клиента. Можно использовать cfg или отдельные параметры сервера"""
         if cfg:
-            self.base_url = cfg.base_url
-            # Убеждаемся, что base_url заканчивается на /
-            if self.base_url and not self.base_url.endswith('/'):
-                self.base_url += '/'
-            self.username = cfg.username
-            self.password = cfg.password
-            self.api_token = cfg.api_token
-            self.inbound_id = cfg.inbound_id
-        else:
-            if not base_url:
-                raise ValueError("Either cfg or base_url must be provided")
-            # Сохраняем base_url как есть (он уже должен заканчиваться на /)
-            # Не добавляем лишний /, чтобы не нарушить путь, если он уже есть
-            self.base_url = base_url if base_url else None
-            # Если base_url не заканчивается на /, добавляем его
-            if self.base_url and not self.base_url.endswith('/'):
-                self.base_url += '/'
-            self.username = username
-            self.password = password
-            self.api_token = api_token
-            self.inbound_id = inbound_id
-        
-        # Создаем HTTP клиент
+            base_url, username, password = cfg.base_url, cfg.username, cfg.password
+            api_token, inbound_id = cfg.api_token, cfg.inbound_id
+        elif not base_url:
+            raise ValueError("Either cfg or base_url must be provided")
+        # Убеждаемся, что base_url заканчивается на /, не трогая путь панели, если он есть
+        if base_url and not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.api_token = api_token
+        self.inbound_id = inbound_id
+        
+        # Создаем асинхронный HTTP клиент: запросы к панели не блокируют цикл событий,
+        # а соединения (HTTP/2 и keep-alive) переиспользуются между вызовами
         # httpx автоматически обрабатывает пути в base_url
         # Например: base_url="http://host:port/path/" + endpoint="/panel/api/..." 
         # даст "http://host:port/path/panel/api/..."
-        self._client = httpx.Client(
+        self._client = httpx.AsyncClient(
             base_url=self.base_url, 
+            http2=True,
             timeout=20.0, 
-            verify=False,
+            verify=PANEL_SSL_CONTEXT,
+            # По умолчанию httpx закрывает простаивающее соединение через 5 с, а ключи
+            # создаются реже: держим его минуту, чтобы не повторять TLS-рукопожатие
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60.0),
+            # Токен не меняется, поэтому заголовок авторизации задаем один раз для всех запросов
+            headers={"Authorization": f"Bearer {self.api_token}"} if self.api_token else None,
             follow_redirects=True
         )
         self._authorized = False
+        # (время получения, inbound, шаблон ссылки vless)
+        self._inbound_cache: tuple[float, dict[str, Any], str] | None = None
+        # Фоновое обновление устаревшего кэша inbound
+        self._refresh_task: asyncio.Task | None = None
+        # Endpoint, которым в прошлый раз удалось выполнить действие ("delete" / "expiry")
+        self._working_endpoints: dict[str, str] = {}
+        # Суффикс email клиента: email на панели уникален, а два ключа одного пользователя,
+        # созданные в одну секунду, по времени совпали бы. Счетчик начинается со времени
+        # создания клиента, поэтому после перезапуска бота значения не повторяются
+        self._email_seq = itertools.count(int(time.time()))
 
-    def _auth_headers(self) -> dict[str, str]:
-        if self.api_token:
-            return {"Authorization": f"Bearer {self.api_token}"}
-        return {}
+    async def aclose(self) -> None:
+        """Закрывает соединения с панелью"""
+        await self._client.aclose()
 
-    def login(self) -> None:
+    async def login(self) -> None:
         if self.api_token:
             self._authorized = True
             return
@@ -89,7 +133,7 @@ class XUIClient:
         # Путь /login будет автоматически добавлен к base_url
         # Например: http://host:port/path/ + /login = http://host:port/path/login
         try:
-            resp = self._client.post(
+            resp = await self._client.post(
                 "login",  # Без начального /, чтобы httpx правильно объединил с base_url
                 data={"username": self.username, "password": self.password}
             )
@@ -103,11 +147,106 @@ class XUIClient:
         except Exception as e:
             raise RuntimeError(f"Login error: {e}")
 
-    def ensure_login(self) -> None:
+    async def ensure_login(self) -> None:
         if not self._authorized:
-            self.login()
+            await self.login()
+
+    async def _request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """Запрос к панели; при истекшей сессии логинится заново и повторяет запрос один раз.
+
+        Клиент переиспользуется между запросами бота, поэтому cookie сессии может устареть.
+        """
+        resp = await self._client.request(method, url, **kwargs)
+        if resp.status_code != 401 or self.api_token:
+            return resp
+        self._authorized = False
+        await self.login()
+        return await self._client.request(method, url, **kwargs)
+
+    async def _fetch_inbound(self) -> dict[str, Any]:
+        """Запрашивает inbound клиента с панели и обновляет кэш его описания"""
+        inbound_id = self.inbound_id
+        inbs = _loads((await self._request("GET", "panel/api/inbounds/list")).content).get("obj", [])
+        chosen = next((i for i in inbs if i.get('id') == inbound_id), None)
+        if not chosen:
+            self._inbound_cache = None
+            raise RuntimeError(f'Не найден inbound с ID {inbound_id}')
+        stream_settings = _loads(chosen.get('streamSettings') or '{}')
+        self._inbound_cache = (time.monotonic(), chosen, self._build_link_template(chosen, stream_settings))
+        return chosen
+
+    async def refresh_inbound(self) -> None:
+        """Перечитывает inbound с панели, например после его перенастройки"""
+        await self._fetch_inbound()
+
+    async def _link_template(self) -> str:
+        """Шаблон ссылки из кэша.
+
+        Устаревший шаблон отдается сразу, а inbound перечитывается в фоне, поэтому
+        после первого ключа создание обходится одним запросом addClient.
+        """
+        cached = self._inbound_cache
+        if cached is None:
+            await self._fetch_inbound()
+            return self._inbound_cache[2]
+        if time.monotonic() - cached[0] >= INBOUND_CACHE_TTL and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_inbound_in_background())
+        return cached[2]
+
+    async def _refresh_inbound_in_background(self) -> None:
+        try:
+            await self._fetch_inbound()
+        except Exception as e:
+            # Остается прежний шаблон, следующий ключ попробует обновить его снова
+            logger.warning("[xui] Could not refresh inbound %s: %s", self.inbound_id, e)
+        finally:
+            self._refresh_task = None
 
-    def add_vless_client(
+    def _build_link_template(self, chosen: dict[str, Any], stream_settings: dict[str, Any]) -> str:
+        """Шаблон ссылки vless для inbound с полями {uuid} и {name}.
+
+        Параметры REALITY зависят только от настроек inbound, поэтому разбираются
+        один раз при обновлении кэша, а не на каждый ключ.
+        """
+        port = chosen.get('port') or 'PORT'
+        reality_settings = stream_settings.get('realitySettings') or {}
+
+        # Извлекаем параметры REALITY из настроек панели
+        # settings может быть объектом или строкой JSON
+        settings = reality_settings.get('settings') or {}
+        if isinstance(settings, str):
+            try:
+                settings = _loads(settings)
+            except ValueError:
+                settings = {}
+        if not isinstance(settings, dict):
+            settings = {}
+
+        pbk = settings.get('publicKey', '')
+        # shortId (sid) - может быть в realitySettings.shortId, shortIds или settings.shortId, shortIds
+        sid = (reality_settings.get('shortId') or _first(reality_settings.get('shortIds'))
+               or settings.get('shortId') or _first(settings.get('shortIds')))
+        sni = _first(reality_settings.get('serverNames')) or 'google.com'
+        # fingerprints (fp) - в settings.fingerprints или realitySettings.fingerprints
+        fp = _first(settings.get('fingerprints') or reality_settings.get('fingerprints')) or 'chrome'
+        
+        # Получаем IP сервера из настроек inbound или из base_url
+        server_ip = chosen.get('listen') or ''
+        if not server_ip or server_ip == '0.0.0.0' or server_ip == '':
+            # Берем IP/домен из base_url
+            # Убираем протокол и путь
+            url_part = self.base_url.split('//')[-1].split('/')[0]
+            # Извлекаем хост (без порта)
+            server_ip = url_part.split(':')[0]
+        
+        # Формируем ссылку vless в правильном порядке параметров
+        pbk_param = f"&pbk={pbk}" if pbk else ""
+        link = (f"@{server_ip}:{port}/?type=tcp&encryption=none&security=reality{pbk_param}"
+                f"&fp={fp}&sni={sni}&sid={sid or '3d'}&spx=%2F&flow=xtls-rprx-vision")
+        # Фигурные скобки в значениях экранируем, чтобы не сломать format()
+        return "vless://{uuid}" + link.replace('{', '{{').replace('}', '}}') + "#{name}"
+
+    async def add_vless_client(
         self,
         telegram_user_id: int,
         display_name: str,
@@ -115,17 +254,16 @@ class XUIClient:
         days_valid: int | None = 30,
         expiry_time_unix_ms: int | None = None,
     ) -> dict[str, Any]:
-        self.ensure_login()
+        await self.ensure_login()
 
-        import datetime
         # Если передан expiry_time_unix_ms, используем его, иначе вычисляем из days_valid
         if expiry_time_unix_ms is not None:
             expiry_time = expiry_time_unix_ms
         else:
-            now_dt = datetime.datetime.now()
-            expiry_time = int(now_dt.timestamp() * 1000) + (86400000 * (days_valid or 30))
+            expiry_time = time.time_ns() // 1_000_000 + 86_400_000 * (days_valid or 30)
+        # Xray принимает id клиента VLESS только в каноническом виде с дефисами, поэтому не hex
         client_uuid = str(uuid.uuid4())
-        email = f"tg_{telegram_user_id}_{int(time.time())}@xui"
+        email = f"tg_{telegram_user_id}_{next(self._email_seq)}@xui"
 
         # Формируем клиента как в вашем рабочем скрипте
         # Если traffic_gb is None или 0, то безлимит (0 байт = безлимит в x-ui)
@@ -148,122 +286,26 @@ class XUIClient:
             raise RuntimeError("inbound_id is not set")
         payload = {
             "id": inbound_id,
-            "settings": json.dumps({"clients": [client_dict]})
+            "settings": _dumps({"clients": [client_dict]})
         }
-        headers = {"Content-Type": "application/json", **self._auth_headers()}
         # Используем путь без начального /, чтобы httpx правильно объединил с base_url
         endpoint = "panel/api/inbounds/addClient"
-        print(f"[xui] POST {self.base_url}{endpoint} payload: {payload}")
-        resp = self._client.post(endpoint, json=payload, headers=headers)
-        print(f"[xui] Status={resp.status_code} Response={resp.text}")
+        # Тела запроса и ответа могут весить килобайты: строим их текст только в режиме отладки
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[xui] POST %s%s payload: %s", self.base_url, endpoint, payload)
+        resp = await self._request("POST", endpoint, content=_dumpb(payload), headers=JSON_HEADERS)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[xui] Status=%s Response=%s", resp.status_code, resp.text)
         if resp.status_code != 200:
+            # Возможно, inbound изменили на панели: при следующем вызове запросим его заново
+            self._inbound_cache = None
             raise RuntimeError(f"addClient failed: {resp.status_code} {resp.text}")
-        data = resp.json()
+        data = _loads(resp.content)
         if not data.get("success", True):
             raise RuntimeError(f"addClient error: {data}")
 
-        # Теперь получим данные inbound через лист (для формирования корректной ссылки)
-        inbs = self._client.get("panel/api/inbounds/list").json().get("obj", [])
-        chosen=None
-        for i in inbs:
-            if i.get('id') == inbound_id:
-                chosen=i
-                break
-        if not chosen:
-            raise RuntimeError('Не найден inbound для формирования ссылки')
-        port = chosen.get('port') or 'PORT'
-        stream_settings = json.loads(chosen.get('streamSettings', '{}'))
-        reality_settings = stream_settings.get('realitySettings') or {}
-        
-        # Извлекаем параметры REALITY из настроек панели
-        pbk = ''
-        sid = ''
-        sni = 'google.com'
-        fp = 'chrome'  # дефолтное значение
-        
-        if reality_settings:
-            # Получаем settings - может быть объектом или строкой JSON
-            settings = reality_settings.get('settings', {})
-            if isinstance(settings, str):
-                try:
-                    settings = json.loads(settings)
-                except:
-                    settings = {}
-            elif not isinstance(settings, dict):
-                settings = {}
-            
-            # Получаем publicKey из settings
-            pbk = settings.get('publicKey', '')
-            
-            # Получаем shortId (sid) - может быть в realitySettings.shortId, shortIds или settings.shortId
-            sid = reality_settings.get('shortId', '')
-            if not sid:
-                # Пробуем получить из shortIds (массив)
-                short_ids = reality_settings.get('shortIds', [])
-                if isinstance(short_ids, list) and len(short_ids) > 0:
-                    sid = short_ids[0]
-                elif isinstance(short_ids, str):
-                    sid = short_ids
-                # Пробуем получить из settings
-                if not sid:
-                    sid = settings.get('shortId', '')
-                    if not sid:
-                        short_ids = settings.get('shortIds', [])
-                        if isinstance(short_ids, list) and len(short_ids) > 0:
-                            sid = short_ids[0]
-                        elif isinstance(short_ids, str):
-                            sid = short_ids
-            
-            # Получаем serverNames (sni) - может быть массивом или строкой
-            sni_list = reality_settings.get('serverNames', [])
-            if isinstance(sni_list, str):
-                try:
-                    sni_list = json.loads(sni_list)
-                except:
-                    sni_list = [sni_list] if sni_list else []
-            if isinstance(sni_list, list) and len(sni_list) > 0:
-                sni = sni_list[0]
-            elif isinstance(sni_list, str) and sni_list:
-                sni = sni_list
-            elif not sni_list or sni_list == []:
-                sni = 'google.com'
-            
-            # Получаем fingerprints (fp) - может быть в settings.fingerprints или realitySettings.fingerprints
-            fingerprints = settings.get('fingerprints', [])
-            if not fingerprints:
-                fingerprints = reality_settings.get('fingerprints', [])
-            
-            if isinstance(fingerprints, str):
-                try:
-                    fingerprints = json.loads(fingerprints)
-                except:
-                    fingerprints = [fingerprints] if fingerprints else []
-            
-            if isinstance(fingerprints, list) and len(fingerprints) > 0:
-                fp = fingerprints[0]
-            elif isinstance(fingerprints, str) and fingerprints:
-                fp = fingerprints
-            else:
-                fp = 'chrome'  # дефолт если не найдено
-        
-        # Получаем IP сервера из настроек inbound или из base_url
-        server_ip = chosen.get('listen') or ''
-        if not server_ip or server_ip == '0.0.0.0' or server_ip == '':
-            # Берем IP/домен из base_url
-            # Убираем протокол и путь
-            url_part = self.base_url.split('//')[-1].split('/')[0]
-            # Извлекаем хост (без порта)
-            server_ip = url_part.split(':')[0]
-        
-        # Формируем ссылку vless в правильном порядке параметров
-        link = f"vless://{client_uuid}@{server_ip}:{port}/?type=tcp&encryption=none&security=reality"
-        if pbk:
-            link += f"&pbk={pbk}"
-        link += f"&fp={fp}"
-        link += f"&sni={sni}"
-        link += f"&sid={sid if sid else '3d'}"
-        link += "&spx=%2F&flow=xtls-rprx-vision"
-        link += f"#{display_name or email.split('@')[0]}"
+        # Шаблон ссылки из кэша inbound (устаревший обновляется в фоне)
+        link = (await self._link_template()).format(uuid=client_uuid, name=display_name or email.split('@')[0])
 
         return {
             "email": email,
@@ -273,38 +315,86 @@ class XUIClient:
             "link": link,
         }
 
-    def delete_client(self, client_id: str) -> None:
+    @staticmethod
+    def _inbound_settings(chosen: dict[str, Any]) -> dict[str, Any]:
+        """settings inbound как словарь со списком clients (панель отдает его строкой JSON)"""
+        settings = chosen.get('settings') or {}
+        if isinstance(settings, (str, bytes)):
+            try:
+                settings = _loads(settings)
+            except ValueError:
+                settings = {}
+        if not isinstance(settings, dict):
+            settings = {}
+        if not isinstance(settings.get('clients'), list):
+            settings['clients'] = []
+        return settings
+
+    @staticmethod
+    def _inbound_payload(chosen: dict[str, Any], settings: dict[str, Any]) -> dict[str, Any]:
+        """Тело запроса на обновление inbound с новыми settings.
+
+        settings кодируется один раз; остальные поля берутся из inbound как есть,
+        без повторного разбора и кодирования.
+        """
+        payload = {key: chosen[key] for key in INBOUND_UPDATE_FIELDS if key in chosen}
+        if 'settings' in payload:
+            payload['settings'] = _dumps(settings)
+        return payload
+
+    @staticmethod
+    def _inbound_update_attempts(inbound_id: int, payload: dict[str, Any]) -> list[tuple[str, str, Any]]:
+        """Способы обновить inbound на разных версиях панели: (метод, endpoint, тело)"""
+        return [
+            # update с ID в пути через POST (работает на этой панели)
+            ("POST", f"panel/api/inbounds/update/{inbound_id}", payload),
+            # updateAll (обычно работает в 3x-ui)
+            ("POST", "panel/api/inbounds/updateAll", [payload]),
+            # update без ID в пути
+            ("POST", "panel/api/inbounds/update", payload),
+        ]
+
+    async def _try_endpoints(self, kind: str, attempts: list[tuple[str, str, Any]], action: str) -> bool:
+        """Выполняет запросы по очереди до первого успешного.
+
+        Запросы меняют один и тот же inbound, поэтому не запускаются параллельно;
+        вместо этого первым пробуется endpoint, сработавший в прошлый раз для того же
+        действия kind (у удаления и продления наборы endpoint разные).
+        """
+        working = self._working_endpoints.get(kind)
+        attempts = sorted(attempts, key=lambda attempt: attempt[1] != working)
+        for method, endpoint, body in attempts:
+            try:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[xui] %s %s%s payload: %s", method, self.base_url, endpoint, body)
+                resp = await self._request(method, endpoint, content=_dumpb(body), headers=JSON_HEADERS)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[xui] Status=%s Response=%s", resp.status_code, resp.text)
+                
+                if resp.status_code == 200:
+                    data = _loads(resp.content)
+                    if data.get("success", True):
+                        logger.debug("[xui] Successfully %s using %s %s", action, method, endpoint)
+                        self._working_endpoints[kind] = endpoint
+                        return True
+            except Exception as e:
+                logger.warning("[xui] %s %s failed: %s", method, endpoint, e)
+        return False
+
+    async def delete_client(self, client_id: str) -> None:
         """Удаляет клиента из inbound на панели x-ui/3x-ui"""
-        self.ensure_login()
+        await self.ensure_login()
         
         inbound_id = self.inbound_id
         if not inbound_id:
             raise RuntimeError("inbound_id is not set")
         
-        # Получаем текущий inbound
-        inbs = self._client.get("panel/api/inbounds/list").json().get("obj", [])
-        chosen = None
-        for i in inbs:
-            if i.get('id') == inbound_id:
-                chosen = i
-                break
-        
-        if not chosen:
-            raise RuntimeError(f'Не найден inbound с ID {inbound_id}')
+        # Получаем текущий inbound (список клиентов нужен свежий, поэтому без кэша)
+        chosen = await self._fetch_inbound()
         
         # Получаем текущие настройки клиентов
-        settings_str = chosen.get('settings', '{}')
-        try:
-            if isinstance(settings_str, str):
-                settings = json.loads(settings_str)
-            else:
-                settings = settings_str
-        except:
-            settings = {}
-        
-        clients = settings.get('clients', [])
-        if not isinstance(clients, list):
-            clients = []
+        settings = self._inbound_settings(chosen)
+        clients = settings['clients']
         
         # Удаляем клиента из списка
         original_count = len(clients)
@@ -312,144 +402,45 @@ class XUIClient:
         
         if len(clients) == original_count:
             # Клиент не найден в списке - возможно уже удален
-            print(f"[xui] Client {client_id} not found in clients list, may already be deleted")
+            logger.info("[xui] Client %s not found in clients list, may already be deleted", client_id)
             return
         
         # Обновляем settings с новым списком клиентов
         settings['clients'] = clients
-        updated_settings = json.dumps(settings)
+        payload = self._inbound_payload(chosen, settings)
         
-        # Формируем payload для обновления inbound
-        # Включаем только необходимые поля, исключая статистику (up, down, total, allTime, clientStats)
-        required_fields = ['id', 'settings', 'streamSettings', 'sniffing', 'protocol', 
-                          'port', 'listen', 'remark', 'enable', 'expiryTime', 
-                          'trafficReset', 'lastTrafficResetTime', 'tag']
-        payload = {}
-        for key in required_fields:
-            if key in chosen:
-                if key == 'settings':
-                    payload[key] = updated_settings
-                else:
-                    payload[key] = chosen[key]
-        
-        headers = {"Content-Type": "application/json", **self._auth_headers()}
-        
-        # Пробуем endpoint update с ID в пути через POST (работает на этой панели)
-        try:
-            endpoint = f"panel/api/inbounds/update/{inbound_id}"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: {payload}")
-            resp = self._client.post(endpoint, json=payload, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully deleted client {client_id} using update/{inbound_id}")
-                    return
-        except Exception as e:
-            print(f"[xui] update/{inbound_id} failed: {e}")
-        
-        # Пробуем endpoint updateAll (обычно работает в 3x-ui)
-        try:
-            payload_all = [payload]
-            endpoint = "panel/api/inbounds/updateAll"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: {payload_all}")
-            resp = self._client.post(endpoint, json=payload_all, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully deleted client {client_id} using updateAll")
-                    return
-        except Exception as e:
-            print(f"[xui] updateAll failed: {e}")
-        
-        # Пробуем endpoint update без ID в пути
-        try:
-            endpoint = "panel/api/inbounds/update"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: {payload}")
-            resp = self._client.post(endpoint, json=payload, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully deleted client {client_id} using update")
-                    return
-        except Exception as e:
-            print(f"[xui] update failed: {e}")
-        
-        # Пробуем endpoint update с PUT методом
-        try:
-            endpoint = f"panel/api/inbounds/{inbound_id}"
-            print(f"[xui] PUT {self.base_url}{endpoint} payload: {payload}")
-            resp = self._client.put(endpoint, json=payload, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully deleted client {client_id} using PUT /{inbound_id}")
-                    return
-        except Exception as e:
-            print(f"[xui] PUT /{inbound_id} failed: {e}")
-        
-        # Если ничего не помогло, пробуем через delClient
-        try:
-            del_payload = {
-                "id": inbound_id,
-                "settings": json.dumps({"clients": [{"id": client_id}]})
-            }
-            endpoint = "panel/api/inbounds/delClient"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: {del_payload}")
-            resp = self._client.post(endpoint, json=del_payload, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully deleted client {client_id} using delClient")
-                    return
-        except Exception as e:
-            print(f"[xui] delClient failed: {e}")
+        # Если ни один способ обновить inbound не сработал, пробуем PUT и delClient
+        del_payload = {
+            "id": inbound_id,
+            "settings": _dumps({"clients": [{"id": client_id}]})
+        }
+        attempts = self._inbound_update_attempts(inbound_id, payload)
+        attempts += [
+            # update с PUT методом
+            ("PUT", f"panel/api/inbounds/{inbound_id}", payload),
+            ("POST", "panel/api/inbounds/delClient", del_payload),
+        ]
+        if await self._try_endpoints("delete", attempts, f"deleted client {client_id}"):
+            return
         
         # Если все методы не сработали, просто логируем ошибку, но не падаем
         # (ключ все равно удалится из БД)
-        print(f"[xui] WARNING: Could not delete client {client_id} from server, but will continue with DB deletion")
+        logger.warning("[xui] Could not delete client %s from server, but will continue with DB deletion", client_id)
     
-    def update_client_expiry(self, client_id: str, expiry_time_unix_ms: int) -> None:
+    async def update_client_expiry(self, client_id: str, expiry_time_unix_ms: int) -> None:
         """Обновляет expiryTime существующего клиента в inbound на панели x-ui/3x-ui"""
-        self.ensure_login()
+        await self.ensure_login()
         
         inbound_id = self.inbound_id
         if not inbound_id:
             raise RuntimeError("inbound_id is not set")
         
-        # Получаем текущий inbound
-        inbs = self._client.get("panel/api/inbounds/list").json().get("obj", [])
-        chosen = None
-        for i in inbs:
-            if i.get('id') == inbound_id:
-                chosen = i
-                break
-        
-        if not chosen:
-            raise RuntimeError(f'Не найден inbound с ID {inbound_id}')
+        # Получаем текущий inbound (список клиентов нужен свежий, поэтому без кэша)
+        chosen = await self._fetch_inbound()
         
         # Получаем текущие настройки клиентов
-        settings_str = chosen.get('settings', '{}')
-        try:
-            if isinstance(settings_str, str):
-                settings = json.loads(settings_str)
-            else:
-                settings = settings_str
-        except:
-            settings = {}
-        
-        clients = settings.get('clients', [])
-        if not isinstance(clients, list):
-            clients = []
+        settings = self._inbound_settings(chosen)
+        clients = settings['clients']
         
         # Находим клиента и обновляем его expiryTime
         client_found = False
@@ -464,67 +455,11 @@ class XUIClient:
         
         # Обновляем settings с обновленным списком клиентов
         settings['clients'] = clients
-        updated_settings = json.dumps(settings)
+        payload = self._inbound_payload(chosen, settings)
         
-        # Формируем payload для обновления inbound
-        required_fields = ['id', 'settings', 'streamSettings', 'sniffing', 'protocol', 
-                          'port', 'listen', 'remark', 'enable', 'expiryTime', 
-                          'trafficReset', 'lastTrafficResetTime', 'tag']
-        payload = {}
-        for key in required_fields:
-            if key in chosen:
-                if key == 'settings':
-                    payload[key] = updated_settings
-                else:
-                    payload[key] = chosen[key]
-        
-        headers = {"Content-Type": "application/json", **self._auth_headers()}
-        
-        # Пробуем endpoint update с ID в пути через POST (работает на этой панели)
-        try:
-            endpoint = f"panel/api/inbounds/update/{inbound_id}"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: updating client {client_id} expiry to {expiry_time_unix_ms}")
-            resp = self._client.post(endpoint, json=payload, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully updated client {client_id} expiry using update/{inbound_id}")
-                    return
-        except Exception as e:
-            print(f"[xui] update/{inbound_id} failed: {e}")
-        
-        # Пробуем endpoint updateAll (обычно работает в 3x-ui)
-        try:
-            payload_all = [payload]
-            endpoint = "panel/api/inbounds/updateAll"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: {payload_all}")
-            resp = self._client.post(endpoint, json=payload_all, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully updated client {client_id} expiry using updateAll")
-                    return
-        except Exception as e:
-            print(f"[xui] updateAll failed: {e}")
-        
-        # Пробуем endpoint update без ID в пути
-        try:
-            endpoint = "panel/api/inbounds/update"
-            print(f"[xui] POST {self.base_url}{endpoint} payload: {payload}")
-            resp = self._client.post(endpoint, json=payload, headers=headers)
-            print(f"[xui] Status={resp.status_code} Response={resp.text}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success", True):
-                    print(f"[xui] Successfully updated client {client_id} expiry using update")
-                    return
-        except Exception as e:
-            print(f"[xui] update failed: {e}")
+        attempts = self._inbound_update_attempts(inbound_id, payload)
+        if await self._try_endpoints("expiry", attempts, f"updated client {client_id} expiry"):
+            return
         
         # Если все методы не сработали, выбрасываем исключение
         raise RuntimeError(f"Could not update client {client_id} expiry on server")